@@ -28,23 +28,40 @@ WRB_LVL1_NAMES_PATH = PROJECT_ROOT / r"data_sm\ESDB-Raster-Library-1k-GeoTIFF-20
 OUT_DIR = PROJECT_ROOT / "results"
 
 PEDOCLIM_STATS_PATH = OUT_DIR / 'france_pedoclim_stats.csv'
+PEDOCLIM_LAND_USE_STATS_PATH = OUT_DIR / 'france_pedoclim_land_use_stats.csv'
 BIOREGION_FRANCE_PATH = OUT_DIR / "shapefile" / "bioregion_france.gpkg"
 CORINE_FRANCE_PATH = OUT_DIR / "rasters" /"CORINE_france.tif"
 WRB_LV1_FRANCE_PATH = OUT_DIR / "rasters" / "WRB_LV1_france.tif"
 RMQS_OTU_STATS = OUT_DIR / "otu_metrics.csv"
+RMQS_RAREFIED_PATH = OUT_DIR / "rarefied_richness.csv"
 BIOREGION_RMQS_PATH = OUT_DIR / "biogeo_assignment.csv"
 FRANCE_HILDA_LAND_USE_PATH = OUT_DIR / "land_use_france.tif"
 LAND_USE_INTENSITY_PATH = OUT_DIR / "land_use_intensity.csv"
 RMQS_FINAL_CSV_PATH = OUT_DIR / "full_dataset.csv" #rmqs with all metadata
 RMQS_FINAL_GEO_PATH = OUT_DIR / "rmqs_final.gpkg"
+RMQS_FINAL_PARQUET_PATH = OUT_DIR / "rmqs_final.parquet"
+RMQS_FINAL_ROW_GROUP_SIZE = 512 # sites per parquet row group, sites are sorted by land_use and bioregion
 SAMPLE_DATASET_PATH = OUT_DIR / "metadata_sample.csv"
 RMQS_BIOREGION_CSV_PATH = OUT_DIR / "bioregion_assignment.csv"
-RMQS_ECOREGION_CSV_PATH = OUT_DIR / "ecoregion_assignment.csv"
+RMQS_REGIONS_CSV_PATH = OUT_DIR / "region_assignment.csv"
 CORINE_CLASS_MAPPING_PATH = OUT_DIR / "CORINE_mapping.json"
 WRB_FINAL_MAPPING_PATH = OUT_DIR / "WRB_mapping.json"
 RMQS_WRB_PATH = OUT_DIR / "wrb_assignment.csv"
+RMQS_COVARIATES_PATH = OUT_DIR / "raster_covariates.csv"
 RMQS_CF_PATH = OUT_DIR / "rmqs_cf_sites.csv"
 RMQS_CF_SUMMARY_PATH = OUT_DIR / "rmqs_cf_summary.csv"
+RMQS_CF_SWEEP_PATH = OUT_DIR / "rmqs_cf_sweep_sites.csv"
+RMQS_CF_SWEEP_SUMMARY_PATH = OUT_DIR / "rmqs_cf_sweep_summary.csv"
+RMQS_CF_SENSITIVITY_PATH = OUT_DIR / "rmqs_cf_sensitivity_sites.csv"
+RMQS_CF_SENSITIVITY_SUMMARY_PATH = OUT_DIR / "rmqs_cf_sensitivity_summary.csv"
+RMQS_CUBE_PATH = OUT_DIR / "rmqs_cube.parquet"
+
+# cache
+CACHE_DIR = OUT_DIR / "cache"
+OTU_CACHE_DIR = CACHE_DIR / "otu"
+STAGE_CACHE_DIR = CACHE_DIR / "stages"
+REGION_CACHE_DIR = CACHE_DIR / "regions"
+OTU_CHUNK_MEMORY_MB = 512 # memory ceiling when parsing the OTU table by chunks
 
 LAND_USE_SIMPLE_MAPPING = {
     "friches": "urban sites",                                    
@@ -57,6 +74,20 @@ LAND_USE_SIMPLE_MAPPING = {
     "vignes vergers et cultures perennes arbustives": "permanent crops"
 }
 
+# CORINE level 3 labels matching RMQS land use classes, other CORINE classes are grouped as "other"
+CORINE_LAND_USE_MAPPING = {
+    "Non-irrigated arable land": "annual crops",
+    "Permanently irrigated land": "annual crops",
+    "Rice fields": "annual crops",
+    "Vineyards": "permanent crops",
+    "Fruit trees and berry plantations": "permanent crops",
+    "Olive groves": "permanent crops",
+    "Pastures": "meadows",
+    "Broad-leaved forest": "broadleaved forests",
+    "Coniferous forest": "coniferous forests",
+    "Mixed forest": "coniferous forests", # as in rename_land_use, non broadleaved forests are coniferous
+}
+
 # Define color mapping for land use types
 LAND_USE_COLOR_MAPPING = {
     "urban sites": "grey",
@@ -78,6 +109,46 @@ LAND_USE_INTENSITY_MAPPING = {
         "coniferous forests": 30,   
         "permanent crops": 90
     }
+
+# category order of the land_use column, from the least to the most intensive
+LAND_USE_ORDER = sorted(LAND_USE_INTENSITY_MAPPING, key=LAND_USE_INTENSITY_MAPPING.get)
+
+# site table columns stored as pandas categoricals (see utilities.to_categoricals)
+CATEGORICAL_COLUMNS = ["land_use", "bioregion", "WRB_LVL1", "context", "signific_ger_95", "parent_material"]
+
+# aggregation cube of the site table (see aggregation_cube), aggregated dimensions are labelled CUBE_MARGIN_LABEL
+CUBE_DIMENSIONS = ["land_use", "bioregion", "WRB_LVL1", "context", "signific_ger_95"]
+CUBE_INDICATORS = ["otu_richness", "otu_shannon", "rarefied_otu_richness", "relative_otu_richness", "cf"]
+CUBE_QUANTILES = (0.25, 0.75)
+CUBE_MARGIN_LABEL = "All" # as pivot_table margins
+# rarefaction
+RANDOM_SEED = 42
+RAREFACTION_ITERATIONS = 100
+RAREFACTION_DEPTH_QUANTILE = 0.05 # default depth: this quantile of the site totals, sites below it get NaN
+
+TAXONOMIC_LEVELS = ["KINGDOM", "PHYLUM", "CLASS", "ORDER", "FAMILY", "GENUS"]
+
+# raster layers sampled at RMQS sites by compute_covariates (column name: raster path or (raster path, band))
+COVARIATE_RASTERS = {
+    "WRB_LVL1_code": WRB_LVL1_PATH,
+    "corine_code": CORINE_LANDUSE_PATH,
+    "hilda_code": HILDA_LAND_USE_PATH,
+}
+
+REGION_NEAREST_TOLERANCE = 2000 # m, sites outside region polygons take the nearest region within this distance
+
+# grouping of the WRB classes with few sites (see utilities.relabel_bottom)
+WRB_RELABEL_APPROACH = "min_val_count"
+WRB_RELABEL_PARAM = 50
+
+# cf confidence intervals
+CF_BOOTSTRAP_ITERATIONS = 2000
+CF_CONFIDENCE_LEVEL = 0.95
+
+# cf nearest reference sites
+CF_NEAREST_K = 10
+CF_NEAREST_MIN_DISTANCE = 1000 # m, closer reference sites weigh as if at this distance
+
 # EPSG to box to window in plots
 FRANCE_BOX_EPSG_2154 = (0e6, 6.0e6, 1.1e6, 7.25e6)
 FRANCE_BOX_EPSG_3035 = (2e6, 2.2e6 , 4.2e6, 3.2e6)
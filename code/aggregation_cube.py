@@ -0,0 +1,141 @@
+import hashlib
+from itertools import combinations
+from pathlib import Path
+
+import pandas as pd
+
+import GLOBALS
+from utilities import load_rmqs_data
+
+ALL = GLOBALS.CUBE_MARGIN_LABEL
+
+def cube_statistics(quantiles: tuple[float, ...] = GLOBALS.CUBE_QUANTILES) -> list[str]:
+    """Statistic columns of the cube, quantiles being named q25, q75..."""
+    return ["count", "mean", "median", *[f"q{round(q * 100)}" for q in quantiles]]
+
+def cube_dimensions(cube: pd.DataFrame) -> list[str]:
+    """Dimension columns of a cube (the columns before 'indicator')."""
+    return list(cube.columns[:cube.columns.get_loc("indicator")])
+
+def source_hashes(data: pd.DataFrame, columns: list[str]) -> dict[str, str]:
+    """Hash of the values and site index of each column, telling whether a cube was built from the same sites and values."""
+    return {col: hashlib.sha1(pd.util.hash_pandas_object(data[col], index=True).to_numpy()).hexdigest() for col in columns}
+
+def _aggregate_subset(data: pd.DataFrame, subset: tuple[str, ...], indicators: list[str], quantiles: tuple[float, ...]) -> pd.DataFrame:
+    """Statistics of the indicators grouped by the subset of dimensions, one row per group and indicator."""
+    keys = [data[dim] for dim in subset] or [pd.Series(0, index=data.index, name="_all")]
+    grouped = data[indicators].groupby(keys, observed=True)
+    table = grouped.agg(["count", "mean", "median"]).stack(level=0, future_stack=True)
+    for q, name in zip(quantiles, cube_statistics(quantiles)[3:]):
+        table[name] = grouped.quantile(q).stack(future_stack=True)
+    table = table.rename_axis([*(subset or ["_all"]), "indicator"]).reset_index()
+    return table.drop(columns="_all", errors="ignore")
+
+def build_cube(
+    data: pd.DataFrame,
+    dimensions: list[str] = GLOBALS.CUBE_DIMENSIONS,
+    indicators: list[str] = GLOBALS.CUBE_INDICATORS,
+    quantiles: tuple[float, ...] = GLOBALS.CUBE_QUANTILES,
+    ) -> pd.DataFrame:
+    """
+    Count, mean, median and quantiles of every indicator for every combination of values
+    of every subset of the dimensions, margins included: a dimension aggregated over is labelled
+    CUBE_MARGIN_LABEL, so the row with every dimension at CUBE_MARGIN_LABEL holds the whole site table.
+    Dimensions and indicators missing from data are skipped.
+
+    Returns a long DataFrame with the dimensions (categoricals ending with CUBE_MARGIN_LABEL),
+    indicator and the statistics, see query_cube. attrs["source_hashes"] holds the source_hashes
+    of the dimension and indicator columns of data.
+    """
+    dimensions = [dim for dim in dimensions if dim in data.columns]
+    indicators = [ind for ind in indicators if ind in data.columns]
+    subsets = [subset for size in range(len(dimensions) + 1) for subset in combinations(dimensions, size)]
+    print(f"Aggregating {len(indicators)} indicators over {len(subsets)} subsets of {dimensions}")
+    cube = pd.concat([_aggregate_subset(data, subset, indicators, quantiles) for subset in subsets], ignore_index=True)
+
+    for dim in dimensions:
+        values = data[dim] if isinstance(data[dim].dtype, pd.CategoricalDtype) else data[dim].astype("category")
+        categories = [cat for cat in values.cat.categories if cat != ALL] + [ALL]
+        cube[dim] = pd.Categorical(cube[dim].astype(object).fillna(ALL), categories=categories, ordered=values.cat.ordered)
+    cube["indicator"] = cube["indicator"].astype("category")
+    cube["count"] = cube["count"].astype(int)
+    cube = cube[[*dimensions, "indicator", *cube_statistics(quantiles)]]
+    cube.attrs["source_hashes"] = source_hashes(data, [*dimensions, *indicators]) # kept in the parquet metadata
+    return cube
+
+def query_cube(
+    cube: pd.DataFrame,
+    values: str,
+    index: list[str],
+    columns: list[str] = (),
+    aggfunc: str = "median",
+    margins: bool = False,
+    where: dict | None = None,
+    ) -> pd.DataFrame | pd.Series:
+    """
+    Reads from the cube the same table as data.pivot_table(values, index, columns, aggfunc, margins)
+    without aggregating the sites again.
+
+    :param aggfunc: one of the cube statistics (count, mean, median, q25...)
+    :param where: {dimension: value} restricting the sites, eg {"land_use": "annual crops"}
+    Returns a Series named values if columns is empty, else a DataFrame.
+    """
+    where = where or {}
+    shown = [*index, *columns]
+    rows = (cube["indicator"] == values).to_numpy()
+    for dim in cube_dimensions(cube):
+        if dim in where:
+            rows &= (cube[dim] == where[dim]).to_numpy()
+        elif dim not in shown:
+            rows &= (cube[dim] == ALL).to_numpy()
+        elif not margins:
+            rows &= (cube[dim] != ALL).to_numpy()
+    table = cube.loc[rows].set_index(shown)[aggfunc].rename(values)
+    table.index = table.index.remove_unused_levels() if isinstance(table.index, pd.MultiIndex) else table.index.remove_unused_categories()
+    if columns:
+        table = table.unstack(list(columns))
+    return table
+
+def pivot_statistics(cube: pd.DataFrame, values: str, index: list[str], statistics: list[str]) -> pd.DataFrame:
+    """Same as data.pivot_table(values=values, index=index, aggfunc=statistics): columns (statistic, values)."""
+    return pd.concat({stat: query_cube(cube, values, index, aggfunc=stat).to_frame() for stat in statistics}, axis=1)
+
+def write_cube(cube: pd.DataFrame, outfile: Path = GLOBALS.RMQS_CUBE_PATH) -> None:
+    print(f"Writing {outfile}")
+    cube.to_parquet(outfile, index=False)
+    return None
+
+def load_cube(cube_file: Path = GLOBALS.RMQS_CUBE_PATH) -> pd.DataFrame:
+    """Cube written by compute_all, for scripts plotting the final dataset."""
+    if not Path(cube_file).exists():
+        raise FileNotFoundError(f"{cube_file} does not exist, run compute_all.py first")
+    print(f"Reading {cube_file}")
+    return pd.read_parquet(cube_file)
+
+def cube_matches(cube: pd.DataFrame, data: pd.DataFrame, dimensions: list[str], indicators: list[str]) -> bool:
+    """Whether the cube was built from the same sites and values of the dimensions and indicators as data."""
+    hashes = cube.attrs.get("source_hashes", {})
+    columns = [*dimensions, *indicators]
+    return set(columns) <= set(data.columns) and all(hashes.get(col) == value for col, value in source_hashes(data, columns).items())
+
+def load_cube_for(
+    data: pd.DataFrame,
+    dimensions: list[str],
+    indicators: list[str],
+    cube_file: Path = GLOBALS.RMQS_CUBE_PATH,
+    ) -> pd.DataFrame:
+    """
+    Cube to query statistics of data by dimensions: the precomputed cube when it was built from the same
+    values of these columns (see cube_matches), else (no cube yet, groups merged by relabel_bottom, sites filtered,
+    indicators recomputed) a cube built from data, over these dimensions and indicators only.
+    """
+    if Path(cube_file).exists():
+        cube = load_cube(cube_file)
+        if cube_matches(cube, data, dimensions, indicators):
+            return cube
+        print(f"{list(dimensions)} or {list(indicators)} of the sites differ from {cube_file}, aggregating the sites again")
+    return build_cube(data, dimensions=dimensions, indicators=indicators)
+
+if __name__ == "__main__":
+    cube = build_cube(load_rmqs_data())
+    write_cube(cube)
@@ -1,31 +1,30 @@
 import pandas as pd
 
-from compute_otu_metrics import read_taxonomy, read_otu_table
-from utilities import save_fig
+from compute_otu_metrics import read_taxonomy
+from otu_utilities import SparseOtuTable, load_otu_matrix, aggregate_taxonomic_levels
+from utilities import save_fig, load_rmqs_data
 import GLOBALS
 
-def build_level_site_table(otu_taxonomy: pd.DataFrame, site_otu_table: pd.DataFrame, level: str) -> pd.DataFrame:
+def build_level_site_table(otu_taxonomy: pd.DataFrame, site_otu_table: SparseOtuTable, level: str) -> pd.DataFrame:
     """
     Build the table of level richness by site
     level can be KINGDOM, PHYLUM, CLASS, ORDER, FAMILY, GENUS
     """
-    #clean otu_taxonomy level column
-    otu_taxonomy[level] = otu_taxonomy[level].fillna(f"unclassified_{level}").astype(str)
-    otu_taxonomy[level] = otu_taxonomy[level].replace("Unknown", f"unclassified_{level}")
+    return build_level_site_tables(otu_taxonomy, site_otu_table, levels=[level])[level]
 
-    #convert site_otu_table from abundance to presence (richness)
-    site_otu_table = site_otu_table.astype(bool) 
-
-    #group otus (otu_table columns) by tax_labels
-    level_site_table = site_otu_table.groupby(otu_taxonomy[level], axis=1).sum()
-
-    return level_site_table
+def build_level_site_tables(otu_taxonomy: pd.DataFrame, site_otu_table: SparseOtuTable, levels: list[str] = GLOBALS.TAXONOMIC_LEVELS) -> dict[str, pd.DataFrame]:
+    """
+    Build the tables of level richness (number of OTUs present per taxon) by site for several levels at once,
+    with one sparse product per level instead of a groupby over the dense OTU table.
+    """
+    level_tables = aggregate_taxonomic_levels(site_otu_table, otu_taxonomy, levels)
+    return {level: tables["presence"] for level, tables in level_tables.items()}
 
 def build_level_land_use_table(level_site_table: pd.DataFrame, site_metadata: pd.DataFrame) -> pd.DataFrame:
     """Build the table of mean level richness by land use"""
 
     #group sites (otu_table rows) by land_use
-    level_land_use_table = level_site_table.groupby(site_metadata['land_use'], axis=0).mean()
+    level_land_use_table = level_site_table.groupby(site_metadata['land_use'], axis=0, observed=True).mean()
     
     #keep only taxa with more than 100 sites
     acceptable_levels = [col for col in level_site_table.columns if (level_site_table[col] > 0).sum() > 100]
@@ -67,29 +66,21 @@ def main():
     """
     Generates plots to study the variability of bacteria at different taxonomic levels (see ./results/taxonomy)
     """
-    if True:
-        otu_taxonomy = read_taxonomy()
-        site_otu_table = read_otu_table()
-        site_metadata = pd.read_csv
-        if False:
-            import pickle
-            with open("./results/temp.pkl", "wb") as f:
-                pickle.dump((otu_taxonomy, site_otu_table, site_metadata), f)
-    else:
-        import pickle
-        with open("./results/temp.pkl", "rb") as f:
-            otu_taxonomy, site_otu_table, site_metadata = pickle.load(f)
-    
-    level = "PHYLUM" #KINGDOM, PHYLUM, CLASS, ORDER, FAMILY, GENUS
+    otu_taxonomy = read_taxonomy()
+    site_otu_table = load_otu_matrix()
+    site_metadata = load_rmqs_data(columns=["land_use"])
     
-    level_site_table = build_level_site_table(
-        otu_taxonomy=otu_taxonomy, site_otu_table=site_otu_table, level=level)
+    levels = GLOBALS.TAXONOMIC_LEVELS #KINGDOM, PHYLUM, CLASS, ORDER, FAMILY, GENUS
     
-    level_land_use_table = build_level_land_use_table(
-        level_site_table=level_site_table, site_metadata=site_metadata)
+    level_site_tables = build_level_site_tables(
+        otu_taxonomy=otu_taxonomy, site_otu_table=site_otu_table, levels=levels)
     
-    plot_level_land_use_table(
-        level_land_use_table=level_land_use_table, level=level, site_metadata=site_metadata, level_site_table=level_site_table)
+    for level, level_site_table in level_site_tables.items():
+        level_land_use_table = build_level_land_use_table(
+            level_site_table=level_site_table, site_metadata=site_metadata)
+        
+        plot_level_land_use_table(
+            level_land_use_table=level_land_use_table, level=level, site_metadata=site_metadata, level_site_table=level_site_table)
     
     return None
 
@@ -3,14 +3,31 @@ import pandas as pd
 
 import GLOBALS
 import utilities
+import geo_utilities
+import otu_utilities
 from geo_utilities import get_rmqs_gdf_from_df
+from stage_cache import stage_key
+from stage_scheduler import Stage, run_stages
 from compute_otu_metrics import compute_otu_metrics
+from compute_rarefaction import compute_rarefaction
 from compute_bioregion import compute_bioregion
 from compute_wrb_class import compute_WRB_class
 from compute_cf import compute_land_use_cf_median_context
+from aggregation_cube import build_cube, write_cube
 
-def compute_all() -> GeoDataFrame:
-    """ Either loads data from csv file or updates it from raw files."""
+def compute_all(
+    context = ["bioregion", 'WRB_LVL1'],
+    reference_land_use = "broadleaved forests",
+    indicator = "otu_richness",
+    reference_mode = "context",
+    ) -> GeoDataFrame:
+    """
+    Either loads data from csv file or updates it from raw files.
+    Each stage is skipped and its columns read back from its intermediate csv
+    when its inputs, code and parameters did not change since the last run (see stage_cache),
+    independent stages run concurrently (see stage_scheduler).
+    The parameters are passed to compute_land_use_cf_median_context.
+    """
     #initial read of the RMQS sample database
     data = pd.read_csv(
         GLOBALS.RMQS_LANDUSE_PATH,
@@ -23,16 +40,48 @@ def compute_all() -> GeoDataFrame:
     data = utilities.rename_land_use(data)
     data = get_rmqs_gdf_from_df(data) # transforms the dataframe into a geodataframe (ie adds a geometry column and some attributes)
     #data = utilities.add_soil_metadata(data)
+    # only this module and the helpers used above, following its imports would bring every stage module in the base key
+    base_key = stage_key(compute_all, inputs=[GLOBALS.RMQS_LANDUSE_PATH, utilities.__file__, geo_utilities.__file__], follow_imports=False)
 
-    # add self made data
-    data = compute_otu_metrics(data)
-    data = compute_bioregion(data) # add bioregion
-    data = compute_WRB_class(data) # add wrb lvl 1 class
-    data = compute_land_use_cf_median_context(data) # add cf
+    # cf only waits for rarefaction, the longest stage, when rarefied richness is its indicator
+    cf_dependencies = ("compute_otu_metrics", "compute_bioregion", "compute_WRB_class")
+    if indicator == "rarefied_otu_richness":
+        cf_dependencies += ("compute_rarefaction",)
+
+    # add self made data, the first three stages only need the sites and run concurrently
+    # wrb waits for bioregion so that relabel_bottom only counts the sites kept by the bioregion drop
+    stages = [
+        Stage( # add otu metrics
+            compute_otu_metrics, GLOBALS.RMQS_OTU_STATS,
+            inputs=[GLOBALS.RMQS_OTU_TABLE_PATH, GLOBALS.RMQS_TAXONOMY_PATH],
+            executor="process"),
+        Stage( # add depth-normalized richness (runs its own process pool)
+            compute_rarefaction, GLOBALS.RMQS_RAREFIED_PATH,
+            inputs=[GLOBALS.RMQS_OTU_TABLE_PATH]),
+        Stage( # add bioregion
+            compute_bioregion, GLOBALS.RMQS_BIOREGION_CSV_PATH,
+            inputs=[GLOBALS.EEA_BIOREGION_BORDERS_PATH],
+            how="inner"),
+        Stage( # add wrb lvl 1 class
+            compute_WRB_class, GLOBALS.RMQS_WRB_PATH,
+            inputs=[GLOBALS.WRB_LVL1_PATH, GLOBALS.WRB_LVL1_MAPPING_PATH, GLOBALS.WRB_LVL1_NAMES_PATH],
+            depends_on=("compute_bioregion",),
+            executor="main"), # plots the sites on the raster
+        Stage( # add cf
+            compute_land_use_cf_median_context, GLOBALS.RMQS_CF_PATH,
+            params={"context": context, "reference_land_use": reference_land_use, "indicator": indicator, "reference_mode": reference_mode},
+            depends_on=cf_dependencies,
+            executor="main"), # plots the cf distributions
+    ]
+    otu_utilities.build_otu_cache() # parsed once here rather than by the concurrent OTU stages
+    data = run_stages(data, stages, base_key)
+    data = utilities.to_categoricals(data) # stages read back from cache return labels as strings
 
     utilities.write_csv(data, GLOBALS.RMQS_FINAL_CSV_PATH)
     data.to_file(GLOBALS.RMQS_FINAL_GEO_PATH)
     print(f"Wrinting {GLOBALS.RMQS_FINAL_GEO_PATH}")
+    utilities.write_rmqs_data(data) # typed GeoParquet read by load_rmqs_data
+    write_cube(build_cube(data)) # statistics queried by reports instead of pivoting the sites again
     return data
 
 if __name__ == '__main__':
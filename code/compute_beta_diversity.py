@@ -0,0 +1,151 @@
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.spatial.distance import cdist
+
+import GLOBALS
+from otu_utilities import SparseOtuTable, load_otu_matrix
+from utilities import load_rmqs_data, write_csv, run_batches, shared_data
+
+METRICS = ["braycurtis", "jaccard"]
+
+def block_size(n_otus: int, max_memory_mb: float) -> int:
+    """Number of sites per block so that two dense blocks (sites x OTUs, float64) fit in max_memory_mb."""
+    return max(1, int(max_memory_mb * 2**20 // (2 * 8 * n_otus)))
+
+def dissimilarity_block(matrix: sparse.csr_matrix, rows_a: slice, rows_b: slice, metric: str) -> np.ndarray:
+    """
+    Dissimilarity between the sites rows_a and rows_b of the OTU matrix.
+    - braycurtis: sum|xa - xb| / (sum xa + sum xb), on abundances
+    - jaccard: 1 - |A & B| / |A | B|, on presence/absence
+    """
+    a, b = matrix[rows_a], matrix[rows_b]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        match metric:
+            case "braycurtis":
+                l1 = cdist(a.toarray(), b.toarray(), "cityblock")
+                totals = np.asarray(a.sum(axis=1)) + np.asarray(b.sum(axis=1)).T
+                return l1 / totals
+            case "jaccard":
+                a, b = (a > 0).astype(np.int32), (b > 0).astype(np.int32)
+                shared = (a @ b.T).toarray()
+                union = a.getnnz(axis=1)[:, None] + b.getnnz(axis=1)[None, :] - shared
+                return 1 - shared / union
+            case _:
+                raise ValueError(f"metric must be one of {METRICS}.")
+
+def _row_block(rows: slice, step: int, metric: str, dtype) -> np.ndarray:
+    """Worker function: dissimilarity of the sites rows of the shared OTU matrix against all sites, by column blocks."""
+    matrix = shared_data()
+    n_sites = matrix.shape[0]
+    return np.hstack([
+        dissimilarity_block(matrix, rows, slice(col, min(col + step, n_sites)), metric).astype(dtype)
+        for col in range(0, n_sites, step)])
+
+def _group_block(rows: slice, step: int, metric: str, codes: np.ndarray, n_groups: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Worker function: sums and counts of the dissimilarity of pairs (i, j) of the shared OTU matrix, i in rows and j > i,
+    accumulated by (group of i, group of j).
+    """
+    matrix = shared_data()
+    n_sites = matrix.shape[0]
+    start, stop = rows.start, rows.stop
+    sums = np.zeros(n_groups * n_groups)
+    counts = np.zeros(n_groups * n_groups)
+    rows = np.arange(start, stop)
+    for col in range(start, n_sites, step):
+        cols = np.arange(col, min(col + step, n_sites))
+        block = dissimilarity_block(matrix, rows, slice(cols[0], cols[-1] + 1), metric)
+        keep = (rows[:, None] < cols[None, :]) & ~np.isnan(block)
+        pair_codes = (codes[rows][:, None] * n_groups + codes[cols][None, :])[keep]
+        sums += np.bincount(pair_codes, weights=block[keep], minlength=n_groups * n_groups)
+        counts += np.bincount(pair_codes, minlength=n_groups * n_groups)
+    return sums, counts
+
+def _run_blocks(matrix: sparse.csr_matrix, worker, step: int, max_workers: int | None, **kwargs):
+    """Yields worker(rows, step, **kwargs) for every block of step rows of matrix, in block order (see utilities.run_batches)."""
+    blocks = [slice(start, min(start + step, matrix.shape[0])) for start in range(0, matrix.shape[0], step)]
+    # one block per task, so that blocks are written as they come instead of being held by batches
+    yield from run_batches(partial(worker, step=step, **kwargs), blocks, max_workers, shared=matrix, n_batches=len(blocks))
+
+def compute_dissimilarity_matrix(
+    otu_table: SparseOtuTable,
+    metric: str = "braycurtis",
+    dtype=np.float32,
+    memmap_path: Path | None = None,
+    max_memory_mb: float = GLOBALS.OTU_CHUNK_MEMORY_MB,
+    max_workers: int | None = None,
+    ) -> np.ndarray:
+    """
+    Full sites x sites dissimilarity matrix (rows and columns follow otu_table.sites).
+    Blocks of sites are computed in parallel, with at most max_memory_mb of dense OTU data per block.
+    If memmap_path is given, the result is a .npy memory-mapped file written block by block.
+    """
+    n_sites, n_otus = otu_table.matrix.shape
+    if memmap_path is not None:
+        print(f"Writing {memmap_path}")
+        result = np.lib.format.open_memmap(memmap_path, mode="w+", dtype=dtype, shape=(n_sites, n_sites))
+    else:
+        result = np.empty((n_sites, n_sites), dtype=dtype)
+
+    step = block_size(n_otus, max_memory_mb)
+    for start, block in zip(range(0, n_sites, step), _run_blocks(otu_table.matrix, _row_block, step, max_workers, metric=metric, dtype=dtype)):
+        result[start:start + len(block)] = block
+    if memmap_path is not None:
+        result.flush()
+    return result
+
+def aggregate_dissimilarity(
+    otu_table: SparseOtuTable,
+    groups: pd.Series,
+    metric: str = "braycurtis",
+    max_memory_mb: float = GLOBALS.OTU_CHUNK_MEMORY_MB,
+    max_workers: int | None = None,
+    ) -> pd.DataFrame:
+    """
+    Mean dissimilarity between sites of each pair of groups (eg land_use, context), within groups on the diagonal.
+    The full matrix is never materialized: each block only adds its pair sums and counts.
+
+    :param groups: group label of each site (indexed by id_site), sites without a label are ignored
+    Returns a long DataFrame with group_a, group_b, mean_dissimilarity, pair_count.
+    """
+    groups = groups.dropna()
+    positions = otu_table.sites.get_indexer(groups.index)
+    groups = groups[positions >= 0]
+    matrix = otu_table.matrix[positions[positions >= 0]]
+    codes, labels = pd.factorize(groups, sort=True)
+    n_groups = len(labels)
+
+    step = block_size(matrix.shape[1], max_memory_mb)
+    sums = np.zeros(n_groups * n_groups)
+    counts = np.zeros(n_groups * n_groups)
+    for block_sums, block_counts in _run_blocks(matrix, _group_block, step, max_workers, metric=metric, codes=codes, n_groups=n_groups):
+        sums += block_sums
+        counts += block_counts
+
+    # pairs were counted once (i < j), symmetrize so that (a, b) and (b, a) hold every pair
+    sums = sums.reshape(n_groups, n_groups)
+    counts = counts.reshape(n_groups, n_groups)
+    sums, counts = sums + sums.T, counts + counts.T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = sums / counts
+    pair_counts = np.where(np.eye(n_groups, dtype=bool), counts // 2, counts) # diagonal pairs were doubled
+
+    group_a, group_b = np.meshgrid(labels, labels, indexing="ij")
+    return pd.DataFrame({
+        "group_a": group_a.ravel(),
+        "group_b": group_b.ravel(),
+        "mean_dissimilarity": means.ravel(),
+        "pair_count": pair_counts.ravel().astype(int),
+        })
+
+if __name__ == "__main__":
+    data = load_rmqs_data(columns=["land_use", "context"])
+    otu_table = load_otu_matrix()
+    for metric in METRICS:
+        for group in ["land_use", "context"]:
+            summary = aggregate_dissimilarity(otu_table, data[group], metric=metric)
+            write_csv(summary, GLOBALS.OUT_DIR / f"beta_{metric}_by_{group}.csv")
@@ -1,40 +1,133 @@
+import hashlib
 from pathlib import Path
+from typing import NamedTuple
 import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import box
 
 import GLOBALS
-from utilities import load_rmqs_data
+from utilities import load_rmqs_data, fingerprint_file
+from geo_utilities import get_france_bounds
 
-def add_region_to_rmqs(
-    rmqs_gdf: gpd.GeoDataFrame,
+# region layers already loaded in this process (cache file -> layer), keeps their spatial index alive
+_REGION_LAYERS: dict[Path, gpd.GeoDataFrame] = {}
+
+def load_region_layer(
     shp_path: Path,
     shp_col: str,
     region_name: str,
-    out_file: Path,
+    crs = GLOBALS.CRS_RMQS,
+    bounds: tuple[float, float, float, float] | None = None,
+    cache_dir: Path = GLOBALS.REGION_CACHE_DIR,
     ) -> gpd.GeoDataFrame:
-    """Assign a region to RMQS sample sites based on a shapefile."""
-    # load polygons and reproject points to polygon CRS
-    regions_gdf = gpd.read_file(shp_path)
-    if rmqs_gdf.crs != regions_gdf.crs:
-        regions_gdf = regions_gdf.to_crs(rmqs_gdf.crs)
+    """
+    Region polygons of a shapefile, with shp_col renamed region_name, clipped to bounds (EPSG:2154) and projected to crs.
+    By default bounds is the extent of the France borders (Corsica included) widened by REGION_NEAREST_TOLERANCE,
+    so that coastal sites can still take the nearest region.
+    The first call reads the shapefile (only the features within bounds) and stores the clipped layer as GeoParquet
+    in cache_dir, keyed on the source fingerprint and the arguments, later calls read the small cached layer.
+    The layer spatial index (STRtree, used by sjoin) is built once per process and reused.
+    """
+    if bounds is None:
+        bounds = get_france_bounds(GLOBALS.FRANCE_BORDERS_PATH, buffer=GLOBALS.REGION_NEAREST_TOLERANCE)
+    key = hashlib.sha1(f"{fingerprint_file(shp_path)}|{shp_col}|{region_name}|{crs}|{bounds}".encode()).hexdigest()[:16]
+    cache_file = Path(cache_dir) / f"{Path(shp_path).stem}_{key}.parquet"
+    if cache_file in _REGION_LAYERS:
+        return _REGION_LAYERS[cache_file]
 
-    regions_gdf[region_name] = regions_gdf[shp_col] # renaming
-    
-    # spatial join to assign regions
-    rmqs_gdf = gpd.sjoin(rmqs_gdf, regions_gdf[[region_name, "geometry"]], how="left", rsuffix = None)
-    failed_values = rmqs_gdf[rmqs_gdf[region_name].isna()]
-    print(f"Removing {len(failed_values)} points falling outside bioregion boundaries.")
-    rmqs_gdf.drop(failed_values.index, inplace=True) #remove points without regions found (fell in beaches and sea)
+    if cache_file.exists():
+        print(f"Reading {cache_file}")
+        regions_gdf = gpd.read_parquet(cache_file)
+    else:
+        print(f"Reading {shp_path}")
+        clip_box = gpd.GeoSeries([box(*bounds)], crs=GLOBALS.CRS_RMQS)
+        source_crs = gpd.read_file(shp_path, rows=0).crs
+        regions_gdf = gpd.read_file(shp_path, bbox=tuple(clip_box.to_crs(source_crs).total_bounds), columns=[shp_col])
+        regions_gdf = regions_gdf.to_crs(GLOBALS.CRS_RMQS).clip(clip_box).to_crs(crs)
+        regions_gdf = regions_gdf.rename(columns={shp_col: region_name})[[region_name, "geometry"]].reset_index(drop=True)
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        print(f"Writing {cache_file}")
+        regions_gdf.to_parquet(cache_file)
+
+    regions_gdf.sindex # build the spatial index now, it is kept with the layer
+    _REGION_LAYERS[cache_file] = regions_gdf
+    return regions_gdf
+
+class RegionLayer(NamedTuple):
+    """Polygon layer assigning a region_name to points from the shp_col attribute of a shapefile."""
+    shp_path: Path
+    shp_col: str
+    region_name: str
+
+BIOREGION_LAYER = RegionLayer(GLOBALS.EEA_BIOREGION_BORDERS_PATH, "code", "bioregion")
+ECOREGION_LAYER = RegionLayer(GLOBALS.WWF_ECOREGIONS_BORDERS_PATH, "ECO_NAME", "ecoregion")
+
+def assign_regions(
+    points: gpd.GeoDataFrame,
+    layers: list[RegionLayer],
+    nearest_tolerance: float = GLOBALS.REGION_NEAREST_TOLERANCE,
+    ) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Assign a region of every layer to each point, querying each layer spatial index once for all points.
+    Points outside every polygon of a layer (eg coastal points falling on beaches or in the sea) take the nearest
+    polygon if it is closer than nearest_tolerance (points crs units), otherwise they are left without region.
+
+    Returns a DataFrame aligned with points with one column per layer region_name,
+    and a report with, per layer, the number of points inside a polygon, assigned to the nearest one and missing.
+    """
+    geometries = points.geometry.values
+    regions = {}
+    report = {}
+    for layer in layers:
+        regions_gdf = load_region_layer(*layer, crs=points.crs)
+        point_idx, region_idx = regions_gdf.sindex.query(geometries, predicate="intersects")
+        assigned = np.full(len(points), -1)
+        assigned[point_idx[::-1]] = region_idx[::-1] # first region found for points on polygon borders, as sjoin
+        inside = assigned >= 0
+
+        missing = np.flatnonzero(~inside)
+        if nearest_tolerance > 0 and len(missing) > 0:
+            near_idx, near_region_idx = regions_gdf.sindex.nearest(geometries[missing], max_distance=nearest_tolerance, return_all=False)
+            assigned[missing[near_idx]] = near_region_idx
+
+        labels = regions_gdf[layer.region_name].to_numpy()
+        regions[layer.region_name] = pd.Series(labels[assigned], index=points.index).where(assigned >= 0)
+        report[layer.region_name] = {
+            "inside": int(inside.sum()),
+            "nearest": int((assigned >= 0).sum() - inside.sum()),
+            "missing": int((assigned < 0).sum()),
+        }
+    return pd.DataFrame(regions), pd.DataFrame(report).T
+
+def add_regions_to_rmqs(
+    rmqs_gdf: gpd.GeoDataFrame,
+    layers: list[RegionLayer],
+    out_file: Path,
+    nearest_tolerance: float = GLOBALS.REGION_NEAREST_TOLERANCE,
+    drop_missing: bool = False,
+    ) -> gpd.GeoDataFrame:
+    """
+    Assign regions of several polygon layers to RMQS sample sites (see assign_regions) and write them in one csv.
+    With drop_missing, sites still without a region in some layer are removed.
+    """
+    regions, report = assign_regions(rmqs_gdf, layers, nearest_tolerance)
+    print(f"Region assignment (nearest polygon within {nearest_tolerance}):\n{report}")
+    rmqs_gdf = rmqs_gdf.join(regions)
+    if drop_missing:
+        missing = regions.isna().any(axis=1)
+        print(f"Removing {missing.sum()} points without {list(regions.columns)}.")
+        rmqs_gdf = rmqs_gdf[~missing.reindex(rmqs_gdf.index)]
     
     # Writing and returning
     print(f"Writing: {out_file}")
-    rmqs_gdf[region_name].to_csv(out_file)
+    rmqs_gdf[regions.columns].to_csv(out_file)
     return rmqs_gdf
 
 def compute_bioregion(data):
-    data = add_region_to_rmqs(data, GLOBALS.EEA_BIOREGION_BORDERS_PATH, shp_col="code", region_name="bioregion", out_file = GLOBALS.RMQS_BIOREGION_CSV_PATH)
+    data = add_regions_to_rmqs(data, [BIOREGION_LAYER], out_file = GLOBALS.RMQS_BIOREGION_CSV_PATH, drop_missing=True)
     return data
 
 if __name__ == "__main__":
-    data = load_rmqs_data()
-    add_region_to_rmqs(data, GLOBALS.EEA_BIOREGION_BORDERS_PATH, shp_col="code", region_name="bioregion", out_file = GLOBALS.RMQS_BIOREGION_CSV_PATH)
-    add_region_to_rmqs(data, GLOBALS.WWF_ECOREGIONS_BORDERS_PATH, shp_col="ECO_NAME", region_name="ecoregion", out_file = GLOBALS.RMQS_ECOREGION_CSV_PATH)
\ No newline at end of file
+    data = load_rmqs_data(columns=[]) # only the sites
+    add_regions_to_rmqs(data, [BIOREGION_LAYER, ECOREGION_LAYER], out_file = GLOBALS.RMQS_REGIONS_CSV_PATH)
@@ -1,26 +1,163 @@
+import warnings
+
 import utilities
 import GLOBALS
 
 import pandas as pd
 import geopandas as gpd
 import numpy as np
+from scipy.spatial import cKDTree
+
+from compute_cf_bootstrap import bootstrap_cf
+
+def build_context(data: pd.DataFrame, context: list[str]) -> pd.Series:
+    """
+    Context of every site: values of the context columns joined by '_' (eg 'Atlantic_Cambisols'),
+    as a categorical so that the CF engine works on integer codes.
+    Missing values become 'nan' in the label as before.
+    """
+    columns = [data[col].astype(str) for col in context]
+    labels = columns[0].str.cat(columns[1:], sep="_") if len(columns) > 1 else columns[0]
+    return labels.astype("category").rename("context")
+
+def reference_medians(indicator: pd.Series, land_use: pd.Series, contexts: pd.Series, reference_land_use: str) -> pd.Series:
+    """
+    Median indicator of the reference land use sites of each context, in one groupby.
+    Indexed by every category of contexts, NaN for contexts without reference site.
+    """
+    is_reference = (land_use == reference_land_use).to_numpy()
+    return indicator[is_reference].groupby(contexts[is_reference], observed=False).median()
+
+def land_use_medians(indicator: pd.Series, land_use: pd.Series, contexts: pd.Series) -> pd.DataFrame:
+    """
+    Median indicator of every context (rows, every category of contexts) x land use (columns), in one groupby.
+    Any land use column is a valid reference, see cf_columns.
+    """
+    return indicator.groupby([contexts, land_use], observed=True).median().unstack().reindex(contexts.cat.categories)
+
+def cf_columns(indicator: pd.Series, contexts: pd.Series, medians: pd.Series) -> pd.DataFrame:
+    """
+    CF of every site, ie 1 - Ic/Ic,ref where Ic,ref is the reference median of the context of the site.
+    The medians (one per category of contexts) are broadcast to the sites by context code,
+    the result is aligned on indicator.index.
+    Returns a DataFrame with context, reference_median_{indicator}, relative_{indicator} and cf.
+    """
+    reference = pd.Series(medians.to_numpy()[contexts.cat.codes.to_numpy()], index=indicator.index)
+    return site_cf_columns(indicator, contexts, reference)
 
-def lookup_reference(row: pd.Series, reference_land_use: str, median_pivot: pd.DataFrame, attribute: str, value: str):
+def site_cf_columns(indicator: pd.Series, contexts: pd.Series, reference: pd.Series) -> pd.DataFrame:
+    """Same as cf_columns with a reference value given for every site."""
+    relative = indicator / reference
+    return pd.DataFrame({
+        "context": contexts,
+        f"reference_median_{indicator.name}": reference,
+        f"relative_{indicator.name}": relative,
+        "cf": 1 - relative,
+        })
+
+def weighted_median(values: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """Row-wise weighted median of (sites, k) arrays, NaN values being ignored."""
+    weights = np.where(np.isnan(values), 0, weights)
+    order = np.argsort(np.where(np.isnan(values), np.inf, values), axis=1)
+    values = np.take_along_axis(values, order, axis=1)
+    cumulative = np.cumsum(np.take_along_axis(weights, order, axis=1), axis=1)
+    total = cumulative[:, -1:]
+    median_position = np.minimum((cumulative < total / 2).sum(axis=1), values.shape[1] - 1)
+    medians = values[np.arange(len(values)), median_position]
+    return np.where(total[:, 0] > 0, medians, np.nan)
+
+def nearest_reference_medians(
+    data: gpd.GeoDataFrame,
+    reference_land_use: str,
+    indicator: str,
+    k: int = GLOBALS.CF_NEAREST_K,
+    contexts: pd.Series | None = None,
+    weighted: bool = False,
+    max_distance: float = np.inf,
+    ) -> pd.Series:
+    """
+    Reference value of every site: median indicator of its k nearest reference land use sites.
+    A single KD-tree is built over the reference sites and queried for all sites at once.
+    A reference site is its own nearest neighbour, as it is part of its context median.
+
+    :param contexts: if given, neighbours are searched within the context of the site only;
+    the context code is added as a third coordinate, far enough to never mix contexts
+    :param weighted: inverse distance weighted median, distances below GLOBALS.CF_NEAREST_MIN_DISTANCE weigh as this distance
+    :param max_distance: neighbours further than this (m) are ignored
+    Sites without any reference neighbour get NaN.
+    """
+    points = data.geometry.to_crs(GLOBALS.CRS_RMQS)
+    coords = np.column_stack([points.x.to_numpy(), points.y.to_numpy(), np.zeros(len(data))])
+    separation = 0.
+    if contexts is not None:
+        # larger than any distance within France, so that no neighbour is taken from another context
+        separation = 2 * (np.ptp(coords[:, :2], axis=0).sum() + 1)
+        coords[:, 2] = contexts.cat.codes.to_numpy() * separation
+    values = data[indicator].to_numpy(dtype=float)
+    is_reference = (data["land_use"] == reference_land_use).to_numpy() & ~np.isnan(values)
+    if not is_reference.any():
+        return pd.Series(np.nan, index=data.index, name=f"reference_median_{indicator}")
+    reference_values = np.append(values[is_reference], np.nan) # missing neighbours get index n_reference
+
+    tree = cKDTree(coords[is_reference])
+    upper_bound = min(max_distance, separation / 2) if contexts is not None else max_distance
+    distances, neighbours = tree.query(coords, k=k, distance_upper_bound=upper_bound, workers=-1)
+    distances, neighbours = distances.reshape(len(data), k), neighbours.reshape(len(data), k)
+    neighbour_values = reference_values[neighbours]
+    if weighted:
+        weights = 1 / np.maximum(distances, GLOBALS.CF_NEAREST_MIN_DISTANCE)
+        medians = weighted_median(neighbour_values, weights)
+    else:
+        with warnings.catch_warnings(): # sites without neighbour
+            warnings.simplefilter("ignore", RuntimeWarning)
+            medians = np.nanmedian(neighbour_values, axis=1)
+    return pd.Series(medians, index=data.index, name=f"reference_median_{indicator}")
+
+def compute_cf_table(
+    data: pd.DataFrame,
+    context: list[str],
+    reference_land_use: str,
+    indicator: str,
+    reference_mode: str = "context",
+    k: int = GLOBALS.CF_NEAREST_K,
+    weighted: bool = False,
+    ) -> pd.DataFrame:
     """
-    Looks up in a pivot containing median values of otu richness for a classifiers
-    replacing the following that does not work : 
-    data["reference_cf"] = pvt.loc[(reference_land_use, data["bioregion"], data["signific_ger_95"])]["otu_richness"].median()
+    CF columns of every site (see cf_columns), the reference following reference_mode:
+    - 'context': median indicator of the reference land use sites of the context of the site
+    - 'nearest': median indicator of the k nearest reference land use sites
+    - 'nearest_context': same as nearest, within the context of the site
+    see nearest_reference_medians for k and weighted.
     """
-    try:
-        return median_pivot.loc[(reference_land_use, row[attribute]), value]
-    except KeyError:
-        return np.nan
+    contexts = build_context(data, context)
+    match reference_mode:
+        case "context":
+            medians = reference_medians(data[indicator], data["land_use"], contexts, reference_land_use)
+            return cf_columns(data[indicator], contexts, medians)
+        case "nearest" | "nearest_context":
+            reference = nearest_reference_medians(
+                data, reference_land_use, indicator, k=k, weighted=weighted,
+                contexts=contexts if reference_mode == "nearest_context" else None)
+            return site_cf_columns(data[indicator], contexts, reference)
+        case _:
+            raise ValueError("reference_mode must be one of 'context', 'nearest', 'nearest_context'.")
+
+def summarize_cf(cf_table: pd.DataFrame, land_use: pd.Series, indicator: str) -> pd.DataFrame:
+    """Median and count of the relative indicator and cf per land use and context."""
+    return cf_table.assign(land_use=land_use).pivot_table(
+        index=['land_use', 'context'],
+        values=[f"relative_{indicator}", "cf"],
+        aggfunc=["median", "count"],
+        observed=True)
 
 def compute_land_use_cf_median_context(
     data: gpd.GeoDataFrame,
     context = ["bioregion", 'WRB_LVL1'],
     reference_land_use = "broadleaved forests",
     indicator = "otu_richness",
+    reference_mode = "context",
+    k = GLOBALS.CF_NEAREST_K,
+    weighted = False,
         ):
     """
     Docstring for compute_cf_median_classified_references
@@ -30,39 +167,20 @@ def compute_land_use_cf_median_context(
     :param classifiers: attributes of data, where each combination of classifier is a consistent group to derive median indicator value
     :param reference_land_use: reference land use to calculate a natural counterfactual indicator value
     :param indicator: indicator for ecosystem quality defined
+    :param reference_mode: 'context' (median of the reference sites of the context), 'nearest' or 'nearest_context'
+    (median of the k nearest reference sites, weighted by inverse distance if weighted), see compute_cf_table
     """
-    # combine classifiers to get the context (supports any number of context columns)
-    data["context"] = data[context].astype(str).agg('_'.join, axis=1)
-
-    # calculate median quality indicator per combination of classifiers
-    median_indicator_context = data.pivot_table(
-        index=['land_use','context'], 
-        values=indicator, 
-        aggfunc="median", 
-        fill_value=np.nan)
-
     # compute cf, ie 1 - Ic/Ic,rel where Ic is the indicator in context c defined by the classifiers
-    data[f"reference_median_{indicator}"] = pd.Series(
-        [lookup_reference(
-            row=row, 
-            reference_land_use=reference_land_use, 
-            median_pivot=median_indicator_context, 
-            attribute="context",
-            value= indicator)
-         for _, row in data.iterrows()]
-    )
-    data[f"relative_{indicator}"] = data[indicator] / data[f"reference_median_{indicator}"]
-    data['cf'] = 1 - data[f"relative_{indicator}"]
-
-    # compute median CF per classifiers
-    median_cf_context = data.pivot_table(
-        index=['land_use', 'context'],
-        values=[f"relative_{indicator}","cf"],
-        aggfunc=["median", "count"])
+    cf_table = compute_cf_table(data, context, reference_land_use, indicator, reference_mode, k, weighted)
+    data = data.assign(**{column: cf_table[column] for column in cf_table.columns})
+
+    # compute median CF per classifiers, with bootstrap confidence intervals of the context medians
+    median_cf_context = summarize_cf(cf_table, data["land_use"], indicator)
+    if reference_mode == "context":
+        median_cf_context = median_cf_context.join(bootstrap_cf(data[indicator], data["land_use"], cf_table["context"], reference_land_use))
     
     # write results in disk and return
-    results_cols = [f"reference_median_{indicator}", f"relative_{indicator}", "cf"]
-    utilities.write_csv(data[results_cols], GLOBALS.RMQS_CF_PATH)
+    utilities.write_csv(cf_table, GLOBALS.RMQS_CF_PATH)
     utilities.write_csv(median_cf_context, GLOBALS.RMQS_CF_SUMMARY_PATH)
 
     # plot distribution of cf values
@@ -75,4 +193,4 @@ def compute_land_use_cf_median_context(
 if __name__ == "__main__":
     indicator = "otu_richness"
     data = utilities.load_rmqs_data()
-    compute_land_use_cf_median_context(data)
\ No newline at end of file
+    compute_land_use_cf_median_context(data)
@@ -0,0 +1,97 @@
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+import GLOBALS
+from utilities import run_batches
+
+def bootstrap_medians(values: np.ndarray, n_boot: int, rng: np.random.Generator) -> np.ndarray:
+    """Medians of n_boot resamples (with replacement) of values, drawn at once as an (n_boot, n) index matrix."""
+    if len(values) == 0:
+        return np.full(n_boot, np.nan)
+    return np.median(values[rng.integers(0, len(values), size=(n_boot, len(values)))], axis=1)
+
+def bootstrap_context(
+    cells: dict[str, np.ndarray],
+    reference_land_use: str,
+    n_boot: int,
+    seed: np.random.SeedSequence,
+    ) -> dict[str, np.ndarray]:
+    """
+    Bootstrap distribution of the median relative indicator of every land use of one context.
+    The reference sites are resampled once, each resample giving a reference median,
+    and the sites of each land use are resampled independently against it.
+
+    :param cells: indicator values of the sites of each land use of the context
+    Returns {land_use: (n_boot,) medians of indicator / reference median}.
+    """
+    rng = np.random.default_rng(seed)
+    reference = bootstrap_medians(cells.get(reference_land_use, np.array([])), n_boot, rng)
+    relative = {}
+    for land_use, values in cells.items():
+        # the reference land use is relative to its own resample, as for the point estimate
+        medians = reference if land_use == reference_land_use else bootstrap_medians(values, n_boot, rng)
+        relative[land_use] = medians / reference
+    return relative
+
+def _bootstrap_context_rows(
+    context: tuple[str, dict[str, np.ndarray], np.random.SeedSequence],
+    reference_land_use: str,
+    n_boot: int,
+    confidence: float,
+    ) -> list[tuple]:
+    """Worker function: (land_use, context, ci_low, ci_high, se) of the median relative indicator for one (context, cells, seed)."""
+    name, cells, seed = context
+    tail = (1 - confidence) / 2
+    rows = []
+    for land_use, relative in bootstrap_context(cells, reference_land_use, n_boot, seed).items():
+        if np.isnan(relative).all():
+            rows.append((land_use, name, np.nan, np.nan, np.nan))
+            continue
+        ci_low, ci_high = np.quantile(relative, [tail, 1 - tail])
+        rows.append((land_use, name, ci_low, ci_high, relative.std(ddof=1)))
+    return rows
+
+def bootstrap_cf(
+    indicator_values: pd.Series,
+    land_use: pd.Series,
+    contexts: pd.Series,
+    reference_land_use: str,
+    n_boot: int = GLOBALS.CF_BOOTSTRAP_ITERATIONS,
+    confidence: float = GLOBALS.CF_CONFIDENCE_LEVEL,
+    seed: int = GLOBALS.RANDOM_SEED,
+    max_workers: int | None = None,
+    ) -> pd.DataFrame:
+    """
+    Bootstrap confidence intervals and standard errors of the median relative indicator and cf
+    of every land use x context cell, sites being resampled within each context.
+
+    :param indicator_values: indicator of every site, sites with a missing indicator are ignored
+    :param contexts: context of every site (see compute_cf.build_context)
+    :param seed: root seed, each context gets its own child seed so results do not depend on max_workers
+    :param max_workers: see utilities.run_batches
+    Returns a DataFrame indexed by land_use and context, with columns
+    (ci_low | ci_high | se, relative_{indicator} | cf) matching the cf summary pivot.
+    """
+    keep = indicator_values.notna()
+    sites = pd.DataFrame({"value": indicator_values, "land_use": land_use, "context": contexts})[keep]
+    grouped = sites.groupby(["context", "land_use"], observed=True)["value"]
+    context_cells: dict[str, dict[str, np.ndarray]] = {}
+    for (context, cell_land_use), values in grouped:
+        context_cells.setdefault(context, {})[cell_land_use] = values.to_numpy(dtype=float)
+    names = sorted(context_cells)
+    seeds = np.random.SeedSequence(seed).spawn(len(names))
+    print(f"Bootstrapping cf of {len(names)} contexts ({n_boot} resamples)")
+
+    worker = partial(_bootstrap_context_rows, reference_land_use=reference_land_use, n_boot=n_boot, confidence=confidence)
+    contexts = zip(names, [context_cells[name] for name in names], seeds)
+    rows = [row for context_rows in run_batches(worker, contexts, 1 if len(names) < 2 else max_workers) for row in context_rows]
+
+    relative_name = f"relative_{indicator_values.name}"
+    relative = pd.DataFrame(rows, columns=["land_use", "context", "ci_low", "ci_high", "se"]).set_index(["land_use", "context"])
+    # cf = 1 - relative: bounds swap and the standard error is unchanged
+    cf = pd.DataFrame({"ci_low": 1 - relative["ci_high"], "ci_high": 1 - relative["ci_low"], "se": relative["se"]})
+    summary = pd.concat({relative_name: relative, "cf": cf}, axis=1).swaplevel(axis=1)
+    columns = pd.MultiIndex.from_product([["ci_low", "ci_high", "se"], ["cf", relative_name]])
+    return summary.reindex(columns=columns).sort_index()
@@ -0,0 +1,132 @@
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+import GLOBALS
+import utilities
+from compute_cf import build_context
+
+class RelabelSetting(NamedTuple):
+    """Grouping approach and parameter of utilities.relabel_bottom."""
+    approach: str
+    param: int | float
+
+    @property
+    def name(self) -> str:
+        return f"{self.approach}={self.param}"
+
+def relabel_settings(
+    top_cats: list[int] = (5, 8, 10, 15),
+    quantile: list[float] = (0.8, 0.9, 0.95, 0.99),
+    min_val_count: list[int] = (10, 20, 30, 50, 75, 100),
+    ) -> list[RelabelSetting]:
+    """Settings covering a range of parameters for each grouping approach."""
+    return ([RelabelSetting("top_cats", param) for param in top_cats]
+            + [RelabelSetting("quantile", param) for param in quantile]
+            + [RelabelSetting("min_val_count", param) for param in min_val_count])
+
+def _collapsed_reference(collapsed: np.ndarray) -> np.ndarray:
+    """
+    Worker function: reference median of every site when the classes flagged in collapsed
+    (indexed by class code) are merged into one class.
+    Sites of kept classes keep their memoised ungrouped median, only the merged groups are recomputed.
+    The site arrays are the data shared by cf_sensitivity (see utilities.run_batches).
+    """
+    sites = utilities.shared_data()
+    is_collapsed = collapsed[sites["class_codes"]]
+    reference = sites["base_reference"].copy()
+    merged = sites["is_reference"] & is_collapsed
+    n_outer = sites["n_outer"]
+    # median per outer context of the reference sites of the merged classes
+    medians = np.full(n_outer, np.nan)
+    values, outer = sites["values"][merged], sites["outer_codes"][merged]
+    for code in np.unique(outer):
+        medians[code] = np.median(values[outer == code])
+    reference[is_collapsed] = medians[sites["outer_codes"][is_collapsed]]
+    return reference
+
+def cf_sensitivity(
+    data: pd.DataFrame,
+    settings: list[RelabelSetting],
+    column: str = "WRB_LVL1",
+    raw_column: str = "WRB_LVL1_full",
+    context: list[str] = ["bioregion", "WRB_LVL1"],
+    reference_land_use: str = "broadleaved forests",
+    indicator: str = "otu_richness",
+    baseline: RelabelSetting = RelabelSetting(GLOBALS.WRB_RELABEL_APPROACH, GLOBALS.WRB_RELABEL_PARAM),
+    bottom_label: str = "Others",
+    max_workers: int | None = None,
+    ) -> pd.DataFrame:
+    """
+    Site CFs when the rare classes of raw_column are grouped following each setting
+    (relabel -> context -> cf chain of compute_WRB_class and compute_cf), and how they move
+    compared to the baseline setting used by the pipeline.
+    The medians of the ungrouped contexts are computed once, and only the groups merged by a setting
+    are recomputed, once per distinct set of merged classes, in a process pool.
+
+    :param column: context column produced by relabelling raw_column
+    :param max_workers: see utilities.run_batches
+    Returns a long DataFrame with setting, approach, param, id_site, context, n_collapsed (number of merged classes),
+    reference_median, cf and cf_change (cf - baseline cf).
+    """
+    settings = list(dict.fromkeys([baseline, *settings]))
+    raw = data[raw_column]
+    counts = utilities.observed_value_counts(raw) # the only pass over the sites needed to relabel, shared by every setting
+    class_codes, classes = pd.factorize(raw.astype(str), sort=True) # NaN is kept as the 'nan' class, as in build_context
+    outer_columns = [col for col in context if col != column]
+    outer = build_context(data, outer_columns) if outer_columns else pd.Series(pd.Categorical(np.zeros(len(data), dtype=int)), index=data.index)
+    outer_codes = outer.cat.codes.to_numpy()
+
+    # memoised medians of the ungrouped contexts (outer context x raw class)
+    values = data[indicator].to_numpy(dtype=float)
+    is_reference = (data["land_use"] == reference_land_use).to_numpy() & ~np.isnan(values)
+    group_codes = outer_codes * len(classes) + class_codes
+    medians = pd.Series(values[is_reference]).groupby(group_codes[is_reference]).median()
+    base_reference = medians.reindex(group_codes).to_numpy()
+
+    # settings merging the same classes share their result
+    collapse_sets = {}
+    for setting in settings:
+        others = utilities.bottom_values(counts, setting.approach, setting.param)
+        collapse_sets.setdefault(frozenset(others), []).append(setting)
+    flags = [classes.isin(list(others)) for others in collapse_sets]
+    print(f"Computing cf for {len(settings)} relabel settings ({len(collapse_sets)} distinct groupings)")
+
+    sites = {"class_codes": class_codes, "outer_codes": outer_codes, "n_outer": len(outer.cat.categories),
+             "values": values, "is_reference": is_reference, "base_reference": base_reference}
+    references = list(utilities.run_batches(_collapsed_reference, flags, max_workers, shared=sites))
+
+    tables = {}
+    for (others, grouped_settings), reference in zip(collapse_sets.items(), references):
+        relabelled = raw.where(~raw.isin(list(others)), bottom_label)
+        table = pd.DataFrame({
+            "context": build_context(data.assign(**{column: relabelled}), context).astype(str),
+            "n_collapsed": len(others),
+            "reference_median": reference,
+            "cf": 1 - values / reference,
+            }, index=data.index)
+        tables.update({s: table.assign(setting=s.name, approach=s.approach, param=s.param) for s in grouped_settings})
+
+    sensitivity = pd.concat([tables[setting] for setting in settings]).rename_axis("id_site").reset_index()
+    baseline_cf = sensitivity.loc[sensitivity["setting"] == baseline.name].set_index("id_site")["cf"]
+    sensitivity["cf_change"] = sensitivity["cf"] - baseline_cf.reindex(sensitivity["id_site"]).to_numpy()
+    columns = ["setting", "approach", "param", "id_site", "context", "n_collapsed", "reference_median", "cf", "cf_change"]
+    return sensitivity[columns]
+
+def summarize_sensitivity(sensitivity: pd.DataFrame) -> pd.DataFrame:
+    """Per setting: number of contexts and of merged classes, sites whose cf changed and size of the changes."""
+    moved = sensitivity["cf_change"].abs()
+    return sensitivity.assign(moved=moved > 1e-12, abs_cf_change=moved).groupby(["setting", "approach", "param"], sort=False).agg(
+        n_contexts=("context", "nunique"),
+        n_collapsed=("n_collapsed", "first"),
+        sites_moved=("moved", "sum"),
+        median_abs_cf_change=("abs_cf_change", "median"),
+        max_abs_cf_change=("abs_cf_change", "max"),
+        ).reset_index()
+
+if __name__ == "__main__":
+    data = utilities.load_rmqs_data(columns=["land_use", "bioregion", "WRB_LVL1_full", "otu_richness"])
+    sensitivity = cf_sensitivity(data, relabel_settings())
+    utilities.write_csv(sensitivity, GLOBALS.RMQS_CF_SENSITIVITY_PATH)
+    utilities.write_csv(summarize_sensitivity(sensitivity), GLOBALS.RMQS_CF_SENSITIVITY_SUMMARY_PATH)
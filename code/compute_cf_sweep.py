@@ -0,0 +1,94 @@
+from itertools import product
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+import GLOBALS
+import utilities
+from compute_cf import build_context, cf_columns, land_use_medians
+
+SCENARIO_COLUMNS = ["scenario", "reference_land_use", "context_columns", "indicator"]
+
+class CfScenario(NamedTuple):
+    """One set of compute_land_use_cf_median_context parameters."""
+    reference_land_use: str
+    context: tuple[str, ...]
+    indicator: str
+
+    @property
+    def name(self) -> str:
+        return f"{self.indicator}|{'+'.join(self.context)}|{self.reference_land_use}"
+
+def scenario_grid(reference_land_uses: list[str], contexts: list[list[str]], indicators: list[str]) -> list[CfScenario]:
+    """Every combination of reference land use, context columns and indicator."""
+    return [CfScenario(reference, tuple(context), indicator)
+            for reference, context, indicator in product(reference_land_uses, contexts, indicators)]
+
+def _sweep_group(group: tuple[pd.Series, pd.Series, list[CfScenario]]) -> pd.DataFrame:
+    """
+    Worker function: site CFs of the scenarios sharing one context and one indicator, from (indicator, contexts, scenarios),
+    the land use of the sites being the data shared by sweep_cf (see utilities.run_batches).
+    The land use medians are computed once and each scenario only picks its reference column.
+    """
+    indicator, contexts, scenarios = group
+    land_use = utilities.shared_data()
+    medians = land_use_medians(indicator, land_use, contexts)
+    tables = []
+    for scenario in scenarios:
+        reference = medians.get(scenario.reference_land_use, pd.Series(np.nan, index=medians.index))
+        table = cf_columns(indicator, contexts, reference).rename(columns={
+            f"reference_median_{indicator.name}": "reference_median",
+            f"relative_{indicator.name}": "relative"})
+        tables.append(table.assign(
+            scenario=scenario.name,
+            reference_land_use=scenario.reference_land_use,
+            context_columns="+".join(scenario.context),
+            indicator=scenario.indicator,
+            land_use=land_use))
+    return pd.concat(tables)
+
+def sweep_cf(data: pd.DataFrame, scenarios: list[CfScenario], max_workers: int | None = None) -> pd.DataFrame:
+    """
+    Site CFs of every scenario, as one long table (one row per scenario and site).
+    Contexts are built once per set of context columns and land use medians once per
+    context and indicator, the (context, indicator) groups running in a process pool.
+
+    :param max_workers: see utilities.run_batches
+    Returns a DataFrame with the SCENARIO_COLUMNS, id_site, land_use, context, reference_median, relative and cf.
+    """
+    contexts = {context: build_context(data, list(context)) for context in dict.fromkeys(s.context for s in scenarios)}
+    groups: dict[tuple, list[CfScenario]] = {}
+    for scenario in scenarios:
+        groups.setdefault((scenario.context, scenario.indicator), []).append(scenario)
+    print(f"Sweeping {len(scenarios)} cf scenarios ({len(groups)} context x indicator groups)")
+
+    items = [(data[indicator], contexts[context], group_scenarios) for (context, indicator), group_scenarios in groups.items()]
+    tables = list(utilities.run_batches(_sweep_group, items, max_workers, shared=data["land_use"]))
+
+    sweep = pd.concat(tables).rename_axis("id_site").reset_index()
+    sweep["context"] = sweep["context"].astype("category")
+    columns = SCENARIO_COLUMNS + ["id_site", "land_use", "context", "reference_median", "relative", "cf"]
+    return sweep[columns]
+
+def summarize_sweep(sweep: pd.DataFrame) -> pd.DataFrame:
+    """Median relative indicator, median cf and site count per scenario, land use and context."""
+    return sweep.groupby(SCENARIO_COLUMNS + ["land_use", "context"], observed=True, sort=False).agg(
+        median_relative=("relative", "median"),
+        median_cf=("cf", "median"),
+        count=("cf", "count"),
+        ).reset_index()
+
+if __name__ == "__main__":
+    data = utilities.load_rmqs_data()
+    if GLOBALS.RMQS_REGIONS_CSV_PATH.exists(): # ecoregions are assigned by compute_bioregion.py
+        regions = pd.read_csv(GLOBALS.RMQS_REGIONS_CSV_PATH, index_col="id_site")
+        data = data.join(regions.drop(columns=data.columns, errors="ignore"))
+    scenarios = scenario_grid(
+        reference_land_uses=["broadleaved forests", "coniferous forests"],
+        contexts=[["bioregion"], ["bioregion", "WRB_LVL1"], ["ecoregion"]],
+        indicators=["otu_richness", "otu_shannon"],
+        )
+    sweep = sweep_cf(data, [s for s in scenarios if all(col in data.columns for col in s.context)])
+    utilities.write_csv(sweep, GLOBALS.RMQS_CF_SWEEP_PATH)
+    utilities.write_csv(summarize_sweep(sweep), GLOBALS.RMQS_CF_SWEEP_SUMMARY_PATH)
@@ -0,0 +1,42 @@
+from pathlib import Path
+
+import geopandas as gpd
+import rasterio
+
+import GLOBALS
+from geo_utilities import sample_rasters_to_geodataframe, neighbourhood_stats_to_geodataframe
+from utilities import load_rmqs_data, write_csv
+
+def compute_covariates(data: gpd.GeoDataFrame, rasters: dict[str, Path | tuple[Path, int]] = GLOBALS.COVARIATE_RASTERS) -> gpd.GeoDataFrame:
+    """
+    Adds the raw raster values of every covariate layer at the RMQS sites, in a single sampling pass.
+    Adding a layer only requires a new entry in GLOBALS.COVARIATE_RASTERS.
+    """
+    covariates = sample_rasters_to_geodataframe(data, rasters)
+    write_csv(covariates, GLOBALS.RMQS_COVARIATES_PATH)
+    data = data.merge(covariates, how='left', right_index=True, left_index=True)
+    return data
+
+def compute_neighbourhood_covariates(
+    data: gpd.GeoDataFrame,
+    raster_path: Path,
+    radius: float,
+    name: str,
+    categorical: bool = True,
+    ) -> gpd.GeoDataFrame:
+    """
+    Adds statistics of the raster pixels within radius (raster crs units) of the RMQS sites,
+    less noisy than the single pixel under the theoretical site coordinates.
+    Categorical rasters give the majority class and class shares, continuous rasters give mean, std and quantiles.
+    """
+    with rasterio.open(raster_path) as raster:
+        stats = neighbourhood_stats_to_geodataframe(data.to_crs(raster.crs), raster, radius, name, categorical=categorical)
+    write_csv(stats, GLOBALS.OUT_DIR / f"neighbourhood_{name}.csv")
+    data = data.merge(stats, how='left', right_index=True, left_index=True)
+    return data
+
+if __name__ == "__main__":
+    data = load_rmqs_data(columns=[])
+    compute_covariates(data)
+    compute_neighbourhood_covariates(data, GLOBALS.CORINE_LANDUSE_PATH, radius=300, name="corine_300m")
+    compute_neighbourhood_covariates(data, GLOBALS.WRB_LVL1_PATH, radius=2000, name="WRB_2km")
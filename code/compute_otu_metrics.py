@@ -1,56 +1,100 @@
 from pathlib import Path
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 
 import GLOBALS
+from otu_utilities import (
+    SparseOtuTable, TaxonIndicator, build_taxon_indicators, iter_otu_chunks, load_sparse_otu_table, otu_cache_file, sparse_otu_table_mb)
 
-def read_otu_table():
-    return pd.read_csv(
-        GLOBALS.RMQS_OTU_TABLE_PATH,
-        sep="\t",
-        index_col="id_site",
-        compression="gzip",
-        low_memory=False,
-        encoding=GLOBALS.ENCODING_RMQS,
-    )
-
-def compute_otu_richness(otu_df: pd.DataFrame):
+def compute_otu_richness(otu_table: SparseOtuTable):
     # presence/absence richness per sample (rows = samples)
-    otu_richness = (otu_df > 0).sum(axis=1).astype(int)
-    otu_richness.name = "otu_richness"
-    otu_richness = otu_richness.to_frame()
+    otu_richness = pd.Series(otu_table.matrix.getnnz(axis=1), index=otu_table.sites, name="otu_richness")
+    otu_richness = otu_richness.astype(int).to_frame()
     return otu_richness
 
-def compute_total_otu_abundance(otu_df: pd.DataFrame):    # ensure index is string and trimmed
+def compute_total_otu_abundance(otu_table: SparseOtuTable):
     # total abundance per sample (rows = samples)
-    otu_abundance = otu_df.sum(axis=1).astype(int)
-    otu_abundance.name = "total_otu_abundance"
-    otu_abundance = otu_abundance.to_frame()
+    otu_abundance = pd.Series(np.asarray(otu_table.matrix.sum(axis=1)).ravel(), index=otu_table.sites, name="total_otu_abundance")
+    otu_abundance = otu_abundance.astype(int).to_frame()
     return otu_abundance
 
-def compute_mean_level_abundance(otu_table: pd.DataFrame, taxonomy: pd.DataFrame, level: str = "ORDER") -> pd.DataFrame:
+def compute_alpha_diversity(otu_table: SparseOtuTable, ace_rare_threshold: int = 10) -> pd.DataFrame:
+    """
+    Alpha diversity indices per sample, computed in one vectorized pass over the non-zero cells of the table.
+    - otu_shannon: Shannon entropy H = -sum(p ln p)
+    - otu_simpson: Gini-Simpson index 1 - sum(p^2)
+    - otu_pielou: Pielou evenness H / ln(S)
+    - otu_chao1: bias-corrected Chao1 S + F1 (F1 - 1) / (2 (F2 + 1))
+    - otu_ace: abundance-based coverage estimator, OTUs with count <= ace_rare_threshold are rare
+    where p are relative abundances, S the richness and Fi the number of OTUs seen i times.
+    Samples without any read get NaN for every index.
+    """
+    matrix = otu_table.matrix.copy()
+    matrix.eliminate_zeros()
+    n_sites = matrix.shape[0]
+    rows = np.repeat(np.arange(n_sites), np.diff(matrix.indptr)) # sample index of each non-zero cell
+    counts = matrix.data.astype(float)
+
+    def per_site(weights):
+        return np.bincount(rows, weights=weights, minlength=n_sites)
+
+    richness = per_site(None)
+    total = per_site(counts)
+    p = counts / total[rows]
+    singletons = per_site(counts == 1)
+    doubletons = per_site(counts == 2)
+    rare = counts <= ace_rare_threshold
+    rare_richness = per_site(rare)
+    rare_total = per_site(counts * rare)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        shannon = -per_site(p * np.log(p))
+        pielou = np.where(richness > 1, shannon / np.log(richness), np.nan)
+        coverage = 1 - singletons / rare_total
+        gamma2 = np.maximum(
+            rare_richness / coverage * per_site(rare * counts * (counts - 1)) / (rare_total * (rare_total - 1)) - 1, 0)
+        ace = (richness - rare_richness) + rare_richness / coverage + singletons / coverage * gamma2
+    ace = np.where(rare_richness == 0, richness, np.where(coverage > 0, ace, np.nan))
+
+    alpha_diversity = pd.DataFrame({
+        "otu_shannon": shannon,
+        "otu_simpson": 1 - per_site(p ** 2),
+        "otu_pielou": pielou,
+        "otu_chao1": richness + singletons * (singletons - 1) / (2 * (doubletons + 1)),
+        "otu_ace": ace,
+        }, index=otu_table.sites)
+    has_reads = pd.Series(total > 0, index=otu_table.sites)
+    return alpha_diversity.where(has_reads, axis=0) # empty sums would read as perfectly even samples
+
+def compute_mean_level_abundance(
+    otu_table: SparseOtuTable,
+    taxonomy: pd.DataFrame,
+    level: str = "ORDER",
+    indicator: TaxonIndicator | None = None,
+    ) -> pd.DataFrame:
     """
     Aggregate OTU abundances to a taxonomic level.
 
-    - otu_table: array (samples, OTU_IDs): sequence count
+    - otu_table: SparseOtuTable (samples, OTU_IDs): sequence count
     - taxonomy: array (OTU_IDs, taxonomic level): taxa name (level in KINGDOM, PHYLUM, CLASS, ORDER, FAMILY, GENUS)
     - level: str, taxonomic column to aggregate by.
+    - indicator: OTU x taxon indicator of level for the OTUs of otu_table, built from taxonomy if None.
 
-    Returns a DataFrame samples x taxa, values: mean taxa abundance.
+    Returns a DataFrame indexed by samples with one column mean_{level}_abundance: for each sample,
+    the mean over the taxa of the level of the mean OTU abundance of the taxon in the sample.
+    The baseline averaged over samples instead, giving one value per taxon that did not align
+    with the sample index of otu_metrics.csv (the column was empty once merged with the sites).
     """
-    # for each otu, select its taxa at the selected taxonomic level
-    otu_taxa = taxonomy[level].astype(str)
-    
-    #for each otu
-    try:
-        taxonomy.loc[otu_table.columns]
-    except KeyError:
-        print("Warning: Some OTU IDs in the OTU table are missing from the taxonomy data.")
-        taxonomy = taxonomy.reindex(otu_table.columns)
-
-    # group OTU columns by taxon label and aggregate across columns (axis=1 groups columns)
-    taxon_abundance = otu_table.T.groupby(otu_taxa).mean()
-    mean_level_abundance = taxon_abundance.mean(axis=1).to_frame(name=f"mean_{level}_abundance")
+    # sparse OTU x taxon indicator, OTUs missing from the taxonomy are left out
+    if indicator is None:
+        indicator = build_taxon_indicators(taxonomy, otu_table.otus, levels=[level])[level]
+    indicator = indicator.matrix
+
+    # mean OTU abundance of each taxon per sample, then mean across taxa
+    taxon_abundance = (otu_table.matrix @ indicator).toarray() / indicator.sum(axis=0).A1
+    mean_level_abundance = pd.DataFrame(
+        {f"mean_{level}_abundance": taxon_abundance.mean(axis=1)}, index=otu_table.sites)
     return mean_level_abundance
 
 def read_taxonomy(taxonomy_path: Path = GLOBALS.RMQS_TAXONOMY_PATH):
@@ -63,28 +107,66 @@ def read_taxonomy(taxonomy_path: Path = GLOBALS.RMQS_TAXONOMY_PATH):
     )
     taxonomy.index = taxonomy.index.astype(str).str.strip()
     # unify missing labels
-    for level in ["KINGDOM", "PHYLUM", "CLASS", "ORDER", "FAMILY", "GENUS"]:
+    for level in GLOBALS.TAXONOMIC_LEVELS:
         taxonomy[level] = taxonomy[level].fillna(f"unclassified_{level}").astype(str)
         taxonomy[level] = taxonomy[level].replace("Unknown", f"unclassified_{level}")
     return taxonomy
 
-def compute_otu_metrics(data: gpd.GeoDataFrame):
-    """
-    Docstring for compute_otu_metrics
-    """
-    otu_table = read_otu_table()
+def compute_otu_metrics_table(
+    otu_table: SparseOtuTable,
+    taxonomy: pd.DataFrame,
+    level: str = "ORDER",
+    indicator: TaxonIndicator | None = None,
+    ) -> pd.DataFrame:
+    """Per-site OTU metrics (one row per site of otu_table), the content of otu_metrics.csv"""
     otu_richness = compute_otu_richness(otu_table)
     otu_abundance = compute_total_otu_abundance(otu_table)
-    level = 'ORDER'
-    mean_level_abundance = compute_mean_level_abundance(otu_table, read_taxonomy(), level=level)
-    otu_metrics = pd.concat([otu_richness, otu_abundance, mean_level_abundance], axis=1)
-    
-    # Writing and returning
+    alpha_diversity = compute_alpha_diversity(otu_table)
+    mean_level_abundance = compute_mean_level_abundance(otu_table, taxonomy, level=level, indicator=indicator)
+    return pd.concat([otu_richness, otu_abundance, alpha_diversity, mean_level_abundance], axis=1)
+
+def compute_otu_metrics_streaming(
+    taxonomy: pd.DataFrame,
+    level: str = "ORDER",
+    max_memory_mb: float = GLOBALS.OTU_CHUNK_MEMORY_MB,
+    ) -> pd.DataFrame:
+    """
+    Same table as compute_otu_metrics_table, but walks the gzip OTU table by chunks of sites
+    so that peak memory stays around max_memory_mb whatever the table size.
+    All metrics are per site, so each chunk is computed independently, with one taxon indicator for all chunks.
+    """
+    tables = []
+    indicator = None
+    for chunk in iter_otu_chunks(GLOBALS.RMQS_OTU_TABLE_PATH, max_memory_mb):
+        if indicator is None: # every chunk has the OTU columns of the gzip table
+            indicator = build_taxon_indicators(taxonomy, chunk.otus, levels=[level])[level]
+        tables.append(compute_otu_metrics_table(chunk, taxonomy, level=level, indicator=indicator))
+    return pd.concat(tables)
+
+def write_otu_metrics(data: gpd.GeoDataFrame, otu_metrics: pd.DataFrame) -> gpd.GeoDataFrame:
     print(f"Writing {GLOBALS.RMQS_OTU_STATS}")
     otu_metrics.to_csv(GLOBALS.RMQS_OTU_STATS, index=True)
     data = data.merge(otu_metrics, how='left', right_index=True, left_index=True)
     return data
 
+def compute_otu_metrics(data: gpd.GeoDataFrame, max_memory_mb: float = GLOBALS.OTU_CHUNK_MEMORY_MB):
+    """
+    Adds per-site OTU metrics (richness, total abundance, alpha diversity, mean ORDER abundance) to data
+    and writes them to otu_metrics.csv.
+    They are computed from the cached sparse OTU table when it fits max_memory_mb,
+    otherwise (or without cache) by chunks of the gzip table (see compute_otu_metrics_streaming).
+    """
+    taxonomy = read_taxonomy()
+    cache_file = otu_cache_file()
+    # the per non-zero cell arrays of compute_alpha_diversity weigh about 8 times the sparse table
+    if cache_file.exists() and 8 * sparse_otu_table_mb(cache_file) <= max_memory_mb:
+        print(f"Reading {cache_file}")
+        otu_metrics = compute_otu_metrics_table(load_sparse_otu_table(cache_file), taxonomy, level='ORDER')
+    else:
+        print(f"Computing OTU metrics by chunks of {GLOBALS.RMQS_OTU_TABLE_PATH} within {max_memory_mb} MB")
+        otu_metrics = compute_otu_metrics_streaming(taxonomy, level='ORDER', max_memory_mb=max_memory_mb)
+    return write_otu_metrics(data, otu_metrics)
+
 if __name__ == "__main__":
     data = pd.DataFrame()
     compute_otu_metrics(data)
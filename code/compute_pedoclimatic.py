@@ -3,9 +3,10 @@ from pathlib import Path
 
 import geopandas as gpd
 import pandas as pd
-import rasterstats
+import rasterio
 
 import GLOBALS
+from zonal_statistics import categorical_zonal_counts, categorical_zonal_crosstab
 
 
 def compute_pedoclimatic_mix_france(
@@ -30,28 +31,12 @@ def compute_pedoclimatic_mix_france(
     mapping = {int(k): v for k, v in mapping_raw.items()}
 
     # compute zonal statistics to get the pixel count for each climate zone and each soil class
-    stats = rasterstats.zonal_stats(
-        vectors=bioregions_france,
-        raster=wrb_raster_path,
-        categorical=True,
-        category_map=mapping,
-        geojson_out=True,
-    )
-
-    # transform the stats output (complex format) into a dataframe
-    rows: list[tuple[str, str, int]] = []
-    for climate in stats:
-        climate: str = climate["id"]
-        props: dict = climate["properties"]
-
-        # Keep only histogram entries (counts). This avoids pulling non-count attributes into the table.
-        for soil_class, pixelcount in props.items():
-            if isinstance(pixelcount, (int, float)):
-                rows.append((climate, soil_class, int(pixelcount)))
+    counts = categorical_zonal_counts(bioregions_france, wrb_raster_path)
+    counts["soil_class"] = [mapping.get(value, value) for value in counts["value"]]
 
     pedoclimatic_data = (
-        pd.DataFrame(rows, columns=["climate", "soil_class", "pixel_count"])
-        .set_index(["climate", "soil_class"])
+        counts.rename(columns={"code": "climate"})
+        .groupby(["climate", "soil_class"], dropna=False)[["pixel_count"]].sum()
     )
 
     # compute relative values, relative pixel count is used to proxy relative surface coverage
@@ -62,6 +47,50 @@ def compute_pedoclimatic_mix_france(
     return pedoclimatic_data
 
 
+def compute_pedoclimatic_land_use_france(
+    bioregion_path: Path = GLOBALS.BIOREGION_FRANCE_PATH,
+    wrb_raster_path: Path = GLOBALS.WRB_LVL1_PATH,
+    corine_raster_path: Path = GLOBALS.CORINE_LANDUSE_PATH,
+    wrb_mapping_path: Path = GLOBALS.WRB_FINAL_MAPPING_PATH,
+    corine_mapping_path: Path = GLOBALS.CORINE_CLASS_MAPPING_PATH,
+    land_use_mapping: dict | None = GLOBALS.CORINE_LAND_USE_MAPPING,
+) -> pd.DataFrame:
+    """
+    Compute the national land-use area in each French pedoclimatic context (climate x soil class),
+    cross-tabulating bioregions, WRB (1 km) and CORINE (100 m) on the CORINE grid.
+
+    :param land_use_mapping: CORINE label to land use class, unmapped labels become "other".
+    None keeps the CORINE labels.
+    Returns a DataFrame indexed by (climate, soil_class, land_use) with:
+      - pixel_count (CORINE pixels)
+      - area_km2
+      - context_share (share of the land use within its climate x soil class context)
+    """
+    bioregions_france = gpd.read_file(bioregion_path).set_index("code")["geometry"]
+    with open(wrb_mapping_path, "r", encoding="utf-8") as file:
+        wrb_mapping = {int(k): v for k, v in json.load(file).items()}
+    with open(corine_mapping_path, "r", encoding="utf-8") as file:
+        corine_mapping = {int(k): v for k, v in json.load(file).items()}
+
+    counts = categorical_zonal_crosstab(bioregions_france, corine_raster_path, wrb_raster_path)
+    counts["soil_class"] = [wrb_mapping.get(value, value) for value in counts["coarse_value"]]
+    counts["land_use"] = [corine_mapping.get(value, value) for value in counts["fine_value"]]
+    if land_use_mapping is not None:
+        counts["land_use"] = counts["land_use"].map(land_use_mapping).fillna("other")
+
+    pedoclimatic_land_use = (
+        counts.rename(columns={"code": "climate"})
+        .groupby(["climate", "soil_class", "land_use"], dropna=False)[["pixel_count"]].sum()
+    )
+    with rasterio.open(corine_raster_path) as corine:
+        pixel_area_km2 = abs(corine.transform.a * corine.transform.e) / 1e6
+    pedoclimatic_land_use["area_km2"] = pedoclimatic_land_use["pixel_count"] * pixel_area_km2
+    pedoclimatic_land_use["context_share"] = (
+        pedoclimatic_land_use["pixel_count"]
+        / pedoclimatic_land_use.groupby(level=["climate", "soil_class"], dropna=False)["pixel_count"].transform("sum"))
+    return pedoclimatic_land_use
+
+
 if __name__ == "__main__":
     pedoclimatic_mix_df = compute_pedoclimatic_mix_france()
 
@@ -69,3 +98,8 @@ if __name__ == "__main__":
     outfile: Path = GLOBALS.PEDOCLIM_STATS_PATH
     print(f"Writing {outfile}")
     pedoclimatic_mix_df.to_csv(outfile, float_format="{:.3f}".format)
+
+    pedoclimatic_land_use_df = compute_pedoclimatic_land_use_france()
+    outfile = GLOBALS.PEDOCLIM_LAND_USE_STATS_PATH
+    print(f"Writing {outfile}")
+    pedoclimatic_land_use_df.to_csv(outfile, float_format="{:.3f}".format)
@@ -0,0 +1,72 @@
+from functools import partial
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+import GLOBALS
+from otu_utilities import SparseOtuTable, load_otu_matrix
+from utilities import run_batches
+
+def rarefy_richness(counts: np.ndarray, depth: int, n_iter: int, seed: np.random.SeedSequence) -> float:
+    """
+    Mean richness of n_iter random subsamples of depth sequences drawn without replacement
+    from the OTU counts of one site. All draws are done at once by a multivariate hypergeometric.
+    """
+    if counts.sum() < depth:
+        return np.nan
+    rng = np.random.default_rng(seed)
+    draws = rng.multivariate_hypergeometric(counts, depth, size=n_iter) # (n_iter, OTUs)
+    return (draws > 0).sum(axis=1).mean()
+
+def _rarefy_site(site: tuple[np.ndarray, np.random.SeedSequence], depth: int, n_iter: int) -> float:
+    """Worker function: rarefied richness of one site, from its (counts, seed)."""
+    counts, seed = site
+    return rarefy_richness(counts, depth, n_iter, seed)
+
+def compute_rarefied_richness(
+    otu_table: SparseOtuTable,
+    depth: int | None = None,
+    n_iter: int = GLOBALS.RAREFACTION_ITERATIONS,
+    seed: int = GLOBALS.RANDOM_SEED,
+    max_workers: int | None = None,
+    depth_quantile: float = GLOBALS.RAREFACTION_DEPTH_QUANTILE,
+    ) -> pd.Series:
+    """
+    Richness of every site rarefied to a common sequencing depth.
+
+    :param depth: number of sequences kept per site, defaults to the depth_quantile of the site total abundances
+    (sites without reads left out) so that a few shallow sites do not set the depth of all others.
+    Sites with less sequences than depth get NaN.
+    :param depth_quantile: quantile of the site totals used when depth is None
+    :param n_iter: number of random subsamples averaged per site
+    :param seed: root seed, each site gets its own child seed so results do not depend on max_workers
+    :param max_workers: see utilities.run_batches
+    """
+    matrix = otu_table.matrix
+    totals = np.asarray(matrix.sum(axis=1)).ravel()
+    if depth is None:
+        depth = int(np.quantile(totals[totals > 0], depth_quantile))
+    print(f"{(totals < depth).sum()} sites with less than {depth} sequences are excluded (NaN)")
+    # only the non-zero counts of each site are needed (csr row slices)
+    site_counts = [matrix.data[start:end].astype(np.int64) for start, end in zip(matrix.indptr[:-1], matrix.indptr[1:])]
+    seeds = np.random.SeedSequence(seed).spawn(len(site_counts))
+    print(f"Rarefying {len(site_counts)} sites to {depth} sequences ({n_iter} iterations)")
+
+    richness = np.array(list(run_batches(partial(_rarefy_site, depth=depth, n_iter=n_iter), zip(site_counts, seeds), max_workers)))
+
+    return pd.Series(richness, index=otu_table.sites, name="rarefied_otu_richness")
+
+def compute_rarefaction(data: gpd.GeoDataFrame, depth: int | None = None) -> gpd.GeoDataFrame:
+    """
+    Adds rarefied_otu_richness to data (usable as cf indicator) and writes it to disk.
+    """
+    rarefied_richness = compute_rarefied_richness(load_otu_matrix(), depth=depth)
+    print(f"Writing {GLOBALS.RMQS_RAREFIED_PATH}")
+    rarefied_richness.to_csv(GLOBALS.RMQS_RAREFIED_PATH, index=True)
+    data = data.merge(rarefied_richness, how='left', right_index=True, left_index=True)
+    return data
+
+if __name__ == "__main__":
+    data = pd.DataFrame()
+    compute_rarefaction(data)
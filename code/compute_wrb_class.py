@@ -45,24 +45,26 @@ def compute_WRB_class(data: gpd.GeoDataFrame):
     
     :param data: Description
     """
+    data = data.copy() # the caller frame is left untouched
     WRB_col_name = 'WRB_LVL1'
     with rasterio.open(GLOBALS.WRB_LVL1_PATH) as wrb: #EPSG3035
-        data = data.to_crs(wrb.crs) #reproject the points rather than the raster because reprojecting raster is tricky
-        geo_utilities.plot_geodataframe_on_raster(wrb, data, "wrb_rmqs")
-        data[WRB_col_name] = geo_utilities.sample_raster_to_geodataframe(data, wrb)
+        geo_utilities.plot_geodataframe_on_raster(wrb, data.to_crs(wrb.crs), "wrb_rmqs")
+    # the points are reprojected to the raster crs rather than the raster because reprojecting raster is tricky
+    data[WRB_col_name] = geo_utilities.sample_rasters_to_geodataframe(data, {WRB_col_name: GLOBALS.WRB_LVL1_PATH})[WRB_col_name]
 
     # convert raster numeric values to text classes
     wrb_mapping = get_WRB_numeric_to_text_mapping()
-    data[WRB_col_name] = data[WRB_col_name].map(wrb_mapping)
-    data[WRB_col_name] = utilities.relabel_bottom(data["WRB_LVL1"], approach='min_val_count', param=50) #group all soil types together if there are less than 50 sampled points
+    data[f"{WRB_col_name}_full"] = data[WRB_col_name].map(wrb_mapping) # kept for compute_cf_sensitivity
+    #group all soil types together if there are less than 50 sampled points
+    data[WRB_col_name] = utilities.relabel_bottom(data[f"{WRB_col_name}_full"], approach=GLOBALS.WRB_RELABEL_APPROACH, param=GLOBALS.WRB_RELABEL_PARAM)
 
     with open(GLOBALS.RMQS_WRB_PATH, "w") as f:
         print(f"Writing {GLOBALS.RMQS_WRB_PATH}")
-        data[WRB_col_name].to_csv(f)
+        data[[WRB_col_name, f"{WRB_col_name}_full"]].to_csv(f)
     return data
 
 if __name__ == '__main__':
-    data = utilities.load_rmqs_data()
+    data = utilities.load_rmqs_data(columns=[])
     compute_WRB_class(data)
 
 """
@@ -1,10 +1,15 @@
+from functools import lru_cache
+from pathlib import Path
+
 import matplotlib.pyplot as plt
+import rasterio
 import rasterio.io as rio
 import rasterio.plot as rplot
 import rasterio.windows as rwindows
 import geopandas as gpd
 import numpy as np
 import pandas as pd
+import warnings
 
 import GLOBALS
 from utilities import save_fig
@@ -19,6 +24,19 @@ def read_corine_on_window(window: rwindows.Window) -> np.ndarray:
     with open(GLOBALS.CORINE_LANDUSE_PATH) as corine:
         return corine.read(1, window=window)
 
+@lru_cache
+def get_france_bounds(
+    borders_path: Path = GLOBALS.FRANCE_BORDERS_PATH,
+    buffer: float = 0,
+    crs = GLOBALS.CRS_RMQS,
+    ) -> tuple[float, float, float, float]:
+    """
+    Extent (xmin, ymin, xmax, ymax) of the France borders in crs, Corsica included, widened by buffer (crs units).
+    The borders file is read once per process and arguments.
+    """
+    xmin, ymin, xmax, ymax = gpd.read_file(borders_path).to_crs(crs).total_bounds
+    return (xmin - buffer, ymin - buffer, xmax + buffer, ymax + buffer)
+
 def box_to_france(ax, crs):
     """Bound a ax to France extent"""
     match crs:
@@ -65,6 +83,49 @@ def get_rmqs_gdf_from_df(data: pd.DataFrame) -> gpd.GeoDataFrame:
     gdf.drop(["x_theo", "y_theo"], axis=1, inplace=True)
     return gdf
 
+def xy_to_rowcol(transform, xs: np.ndarray, ys: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Vectorized rasterio.transform.rowcol: row and col indices of the pixels containing the points."""
+    inverse = ~transform
+    xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+    cols = inverse.a * xs + inverse.b * ys + inverse.c
+    rows = inverse.d * xs + inverse.e * ys + inverse.f
+    return np.floor(rows).astype(np.int64), np.floor(cols).astype(np.int64)
+
+def bounds_to_window(raster: rio.DatasetReader, bounds: tuple[float, float, float, float]) -> rwindows.Window:
+    """Pixel-aligned window of the raster covering the bounds (minx, miny, maxx, maxy), clipped to the raster."""
+    window = rwindows.from_bounds(*bounds, transform=raster.transform)
+    row_off, col_off = int(np.floor(window.row_off)), int(np.floor(window.col_off))
+    row_end, col_end = int(np.ceil(window.row_off + window.height)), int(np.ceil(window.col_off + window.width))
+    window = rwindows.Window(col_off, row_off, col_end - col_off, row_end - row_off)
+    return window.intersection(rwindows.Window(0, 0, raster.width, raster.height))
+
+def sample_raster_points(raster: rio.DatasetReader, xs: np.ndarray, ys: np.ndarray, band: int = 1) -> np.ndarray:
+    """
+    Values of a raster band at points given by coordinates in the raster crs.
+    Coordinates are converted to row/col indices at once, each raster block containing points is read once
+    and values are gathered with fancy indexing.
+    Points outside the raster get the raster nodata value (0 if undefined), like raster.sample.
+    """
+    rows, cols = xy_to_rowcol(raster.transform, xs, ys)
+    fill = raster.nodata if raster.nodata is not None else 0
+    values = np.full(len(rows), fill, dtype=raster.dtypes[band - 1])
+    inside = (rows >= 0) & (rows < raster.height) & (cols >= 0) & (cols < raster.width)
+
+    # group points by raster block, read each needed block once
+    block_height, block_width = raster.block_shapes[band - 1]
+    block_rows, block_cols = rows // block_height, cols // block_width
+    block_ids = block_rows * (raster.width // block_width + 1) + block_cols
+    for block_id in np.unique(block_ids[inside]):
+        in_block = inside & (block_ids == block_id)
+        row_off = block_rows[in_block][0] * block_height
+        col_off = block_cols[in_block][0] * block_width
+        window = rwindows.Window(col_off, row_off,
+                                 min(block_width, raster.width - col_off),
+                                 min(block_height, raster.height - row_off))
+        block = raster.read(band, window=window)
+        values[in_block] = block[rows[in_block] - row_off, cols[in_block] - col_off]
+    return values
+
 def sample_raster_to_geodataframe(geodf: gpd.GeoDataFrame,
                                   raster: rio.DatasetReader,
                                   band_index: int = 0) -> pd.Series:
@@ -72,12 +133,106 @@ def sample_raster_to_geodataframe(geodf: gpd.GeoDataFrame,
     Takes in a geodf and a raster, 
     returns a pd.Series aligned with the geodf,
     Retrieves an information stored in the raster at each point in the geodf.
-    rasterio.sample does not take geometry object and needs work.
+    band_index is the 0-based position of the band (as in the values returned by rasterio.sample).
     """
     check_crs(raster, geodf)
-    series = pd.Series()
-    for idx, geometry in zip(geodf.index, geodf.geometry):
-        coords = [(geometry.x, geometry.y)]
-        for val in raster.sample(coords):
-            series.at[idx] = val[band_index]
-    return series
\ No newline at end of file
+    values = sample_raster_points(raster, geodf.geometry.x.to_numpy(), geodf.geometry.y.to_numpy(), band=band_index + 1)
+    return pd.Series(values, index=geodf.index)
+
+def sample_rasters_to_geodataframe(geodf: gpd.GeoDataFrame, rasters: dict[str, Path | tuple[Path, int]]) -> pd.DataFrame:
+    """
+    Samples several rasters (possibly with different crs and resolutions) at the points of geodf.
+    Points are reprojected once per distinct raster crs, each raster is sampled in batch.
+
+    :param rasters: column name -> raster path, or (raster path, band) to sample another band than the first
+    Returns a DataFrame aligned with geodf with one column per raster.
+    """
+    coords_by_crs = {}
+    columns = {}
+    for name, raster_path in rasters.items():
+        raster_path, band = raster_path if isinstance(raster_path, tuple) else (raster_path, 1)
+        with rasterio.open(raster_path) as raster:
+            crs_key = raster.crs.to_string()
+            if crs_key not in coords_by_crs:
+                points = geodf.geometry.to_crs(raster.crs)
+                coords_by_crs[crs_key] = (points.x.to_numpy(), points.y.to_numpy())
+            columns[name] = sample_raster_points(raster, *coords_by_crs[crs_key], band=band)
+    return pd.DataFrame(columns, index=geodf.index)
+
+def sample_raster_neighbourhood(raster: rio.DatasetReader,
+                                xs: np.ndarray, ys: np.ndarray,
+                                radius: float,
+                                band: int = 1,
+                                square: bool = False) -> np.ndarray:
+    """
+    Pixel values around points given by coordinates in the raster crs.
+    Returns an array (points, neighbourhood pixels) holding every pixel whose center is within radius
+    of the center of the point pixel (square=True: within a square window of half side radius).
+    Points are grouped by raster block and each block is read once with a margin of radius,
+    pixels outside the raster get the raster nodata value (0 if undefined).
+    """
+    rows, cols = xy_to_rowcol(raster.transform, xs, ys)
+    fill = raster.nodata if raster.nodata is not None else 0
+    pixel_width, pixel_height = abs(raster.transform.a), abs(raster.transform.e)
+    half_rows, half_cols = int(radius // pixel_height), int(radius // pixel_width)
+    drows, dcols = np.mgrid[-half_rows:half_rows + 1, -half_cols:half_cols + 1]
+    if not square:
+        in_radius = (drows * pixel_height) ** 2 + (dcols * pixel_width) ** 2 <= radius ** 2
+        drows, dcols = drows[in_radius], dcols[in_radius]
+    drows, dcols = drows.ravel(), dcols.ravel()
+
+    values = np.full((len(rows), len(drows)), fill, dtype=raster.dtypes[band - 1])
+    block_height, block_width = raster.block_shapes[band - 1]
+    block_rows, block_cols = rows // block_height, cols // block_width
+    for block_row, block_col in np.unique(np.column_stack([block_rows, block_cols]), axis=0):
+        in_block = (block_rows == block_row) & (block_cols == block_col)
+        row_off = block_row * block_height - half_rows
+        col_off = block_col * block_width - half_cols
+        window = rwindows.Window(col_off, row_off, block_width + 2 * half_cols, block_height + 2 * half_rows)
+        block = raster.read(band, window=window, boundless=True, fill_value=fill)
+        values[in_block] = block[(rows[in_block] - row_off)[:, None] + drows, (cols[in_block] - col_off)[:, None] + dcols]
+    return values
+
+def neighbourhood_stats_to_geodataframe(geodf: gpd.GeoDataFrame,
+                                        raster: rio.DatasetReader,
+                                        radius: float,
+                                        name: str,
+                                        categorical: bool = True,
+                                        band: int = 1,
+                                        square: bool = False) -> pd.DataFrame:
+    """
+    Statistics of the raster pixels around each point of geodf (see sample_raster_neighbourhood), nodata pixels excluded.
+    - categorical: {name}_majority (most frequent class) and {name}_share_{class} (share of each class)
+    - continuous: {name}_mean, {name}_std, {name}_min, {name}_median, {name}_max
+    plus {name}_pixel_count, the number of valid pixels.
+    Returns a DataFrame aligned with geodf.
+    """
+    check_crs(raster, geodf)
+    values = sample_raster_neighbourhood(raster, geodf.geometry.x.to_numpy(), geodf.geometry.y.to_numpy(), radius, band, square)
+    valid = values != raster.nodata if raster.nodata is not None else np.ones(values.shape, dtype=bool)
+    pixel_count = valid.sum(axis=1)
+
+    if categorical:
+        classes = np.unique(values[valid])
+        codes = np.searchsorted(classes, values)
+        points = np.broadcast_to(np.arange(len(values))[:, None], values.shape)
+        counts = np.bincount((points * len(classes) + codes)[valid], minlength=len(values) * len(classes))
+        counts = counts.reshape(len(values), len(classes))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            shares = counts / pixel_count[:, None]
+        stats = pd.DataFrame(shares, index=geodf.index, columns=[f"{name}_share_{cls}" for cls in classes])
+        majority = pd.Series(classes[counts.argmax(axis=1)], index=geodf.index) if len(classes) else pd.Series(np.nan, index=geodf.index)
+        stats.insert(0, f"{name}_majority", majority.where(pixel_count > 0))
+    else:
+        values = np.where(valid, values, np.nan)
+        with warnings.catch_warnings(): # points without valid pixels get NaN
+            warnings.simplefilter("ignore", RuntimeWarning)
+            stats = pd.DataFrame({
+                f"{name}_mean": np.nanmean(values, axis=1),
+                f"{name}_std": np.nanstd(values, axis=1),
+                f"{name}_min": np.nanmin(values, axis=1),
+                f"{name}_median": np.nanmedian(values, axis=1),
+                f"{name}_max": np.nanmax(values, axis=1),
+                }, index=geodf.index)
+    stats[f"{name}_pixel_count"] = pixel_count
+    return stats
@@ -1,11 +1,17 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import rasterio
-import rasterio.mask as rmask
+import rasterio.features as rfeatures
+import rasterio.windows as rwindows
+from rasterio.enums import Resampling
 import geopandas as gpd
 from pathlib import Path
-from shapely.geometry import Polygon, MultiPolygon
+from shapely import STRtree
+from shapely.geometry import Polygon, MultiPolygon, box
 import numpy as np
 
 import GLOBALS
+from geo_utilities import bounds_to_window
 
 def from_gdf_to_list_polygons(gdf: gpd.GeoDataFrame) -> list[Polygon]:
     """ Adapted to fr.geojson having only one geometry that is a multipolygon"""
@@ -15,35 +21,91 @@ def from_gdf_to_list_polygons(gdf: gpd.GeoDataFrame) -> list[Polygon]:
 def mask_raster_to_vector(
     raster_path: Path, 
     vector_path: Path,
-    ) -> tuple[np.ndarray, dict]:
+    outfile: Path,
+    block_size: int = 512,
+    max_workers: int = 4,
+    overview_factors: tuple[int, ...] = (2, 4, 8, 16),
+    ) -> None:
+    """
+    Writes the raster cropped to the vector bounds, with pixels outside the vector polygons set to nodata.
+    The output is a tiled, compressed GeoTIFF written block by block (with overviews), so the source raster
+    is never fully loaded. Blocks are read and masked on a thread pool, each thread with its own dataset handle.
+    """
     vector = gpd.read_file(vector_path)
     with rasterio.open(raster_path, 'r') as raster:
         vector.to_crs(raster.crs, inplace=True) #reproject vector to raster crs
-        shapes = from_gdf_to_list_polygons(vector)
-        out_image, out_transform = rmask.mask(raster, shapes)
-        out_meta: dict = raster.meta
-
-    out_meta.update({"driver": "GTiff",
-                    "height": out_image.shape[1],
-                    "width": out_image.shape[2],
-                    "transform": out_transform})
-    return out_image, out_meta
-
-def write_raster(image: np.ndarray, meta: dict, outfile: Path):
-    with rasterio.open(outfile, "w", **meta) as dest:
-        print(f"Writing {outfile}")
-        dest.write(image)
+        window = bounds_to_window(raster, vector.total_bounds)
+        out_meta: dict = raster.profile
+        nodata = raster.nodata if raster.nodata is not None else 0 # same default fill as rasterio.mask
+        out_meta.update({"driver": "GTiff",
+                        "height": window.height,
+                        "width": window.width,
+                        "transform": raster.window_transform(window),
+                        "nodata": nodata,
+                        "tiled": True,
+                        "blockxsize": block_size,
+                        "blockysize": block_size,
+                        "compress": "deflate",
+                        "BIGTIFF": "IF_SAFER"})
+    shapes = from_gdf_to_list_polygons(vector)
+    shapes_tree = STRtree(shapes)
+    out_transform = out_meta["transform"]
+    thread_data = threading.local()
+    thread_rasters = []
+
+    def mask_block(block: rwindows.Window) -> tuple[rwindows.Window, np.ndarray]:
+        block_transform = rwindows.transform(block, out_transform)
+        block_shapes = [shapes[i] for i in shapes_tree.query(box(*rwindows.bounds(block, out_transform)))]
+        if not block_shapes: # block fully outside the vector, nothing to read
+            return block, np.full((out_meta["count"], block.height, block.width), nodata, dtype=out_meta["dtype"])
+        if not hasattr(thread_data, "raster"):
+            thread_data.raster = rasterio.open(raster_path, 'r')
+            thread_rasters.append(thread_data.raster)
+        source_block = rwindows.Window(window.col_off + block.col_off, window.row_off + block.row_off, block.width, block.height)
+        image = thread_data.raster.read(window=source_block)
+        outside = rfeatures.geometry_mask(block_shapes, out_shape=(block.height, block.width), transform=block_transform)
+        image[:, outside] = nodata
+        return block, image
+
+    blocks = [
+        rwindows.Window(col, row, min(block_size, window.width - col), min(block_size, window.height - row))
+        for row in range(0, window.height, block_size)
+        for col in range(0, window.width, block_size)]
+    print(f"Writing {outfile}")
+    Path(outfile).parent.mkdir(parents=True, exist_ok=True)
+    with rasterio.open(outfile, "w", **out_meta) as dest, ThreadPoolExecutor(max_workers) as executor:
+        batch_size = 4 * max_workers # bounds the number of masked blocks waiting to be written
+        for start in range(0, len(blocks), batch_size):
+            for block, image in executor.map(mask_block, blocks[start:start + batch_size]):
+                dest.write(image, window=block)
+    for raster in thread_rasters:
+        raster.close()
+
+    with rasterio.open(outfile, "r+") as dest:
+        dest.build_overviews(list(overview_factors), Resampling.nearest)
+        dest.update_tags(ns="rio_overview", resampling="nearest")
     return None
 
 def write_wrb_france():
     """
     Writes a raster for WRBLV1 masked to france borders (smaller)
     """
-    image, meta = mask_raster_to_vector(
+    mask_raster_to_vector(
         raster_path = GLOBALS.WRB_LVL1_PATH,
-        vector_path = GLOBALS.FRANCE_BORDERS_PATH
+        vector_path = GLOBALS.FRANCE_BORDERS_PATH,
+        outfile = GLOBALS.WRB_LV1_FRANCE_PATH,
+    )
+    return None
+
+def write_corine_france():
+    """
+    Writes a raster for CORINE land cover masked to france borders (streamed, the european raster is large)
+    """
+    mask_raster_to_vector(
+        raster_path = GLOBALS.CORINE_LANDUSE_PATH,
+        vector_path = GLOBALS.FRANCE_BORDERS_PATH,
+        outfile = GLOBALS.CORINE_FRANCE_PATH,
     )
-    write_raster(image, meta, GLOBALS.WRB_LV1_FRANCE_PATH)
     return None
 
 def write_bioregion_france():
@@ -0,0 +1,204 @@
+import os
+import threading
+import zipfile
+from pathlib import Path
+from typing import Iterator, NamedTuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+import GLOBALS
+from utilities import fingerprint_file
+
+class SparseOtuTable(NamedTuple):
+    """
+    Site x OTU abundance matrix stored as CSR, with the labels of its rows and columns.
+    - matrix: scipy.sparse.csr_matrix (sites, OTUs): sequence count
+    - sites: pd.Index of id_site (matrix rows)
+    - otus: pd.Index of OTU ids (matrix columns)
+    """
+    matrix: sparse.csr_matrix
+    sites: pd.Index
+    otus: pd.Index
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Dense pandas version of the table, as in the gzip OTU table (memory heavy)."""
+        return pd.DataFrame(self.matrix.toarray(), index=self.sites, columns=self.otus)
+
+class TaxonIndicator(NamedTuple):
+    """
+    Sparse OTU x taxon membership matrix of a taxonomic level.
+    - matrix: scipy.sparse.csr_matrix (OTUs, taxa), 1 where the OTU belongs to the taxon
+    - taxa: pd.Index of taxon names (matrix columns)
+    """
+    matrix: sparse.csr_matrix
+    taxa: pd.Index
+
+def otu_chunk_size(otu_table_path: Path = GLOBALS.RMQS_OTU_TABLE_PATH, max_memory_mb: float = GLOBALS.OTU_CHUNK_MEMORY_MB) -> int:
+    """
+    Number of table rows (sites) that can be parsed at once within max_memory_mb.
+    A parsed cell costs 8 bytes (int64) and the csv parser roughly doubles it, hence 3 x 8 bytes per cell.
+    """
+    header = pd.read_csv(otu_table_path, sep="\t", index_col="id_site", compression="gzip",
+                         encoding=GLOBALS.ENCODING_RMQS, nrows=0)
+    bytes_per_row = 3 * 8 * max(len(header.columns), 1)
+    return max(1, int(max_memory_mb * 2**20 // bytes_per_row))
+
+def iter_otu_chunks(
+    otu_table_path: Path = GLOBALS.RMQS_OTU_TABLE_PATH,
+    max_memory_mb: float = GLOBALS.OTU_CHUNK_MEMORY_MB,
+    ) -> Iterator[SparseOtuTable]:
+    """
+    Walk the gzip OTU table by chunks of rows, yielding each chunk as a SparseOtuTable.
+    Peak memory is bounded by max_memory_mb (dense chunk) instead of sites x OTUs.
+    """
+    chunks = pd.read_csv(
+        otu_table_path,
+        sep="\t",
+        index_col="id_site",
+        compression="gzip",
+        encoding=GLOBALS.ENCODING_RMQS,
+        chunksize=otu_chunk_size(otu_table_path, max_memory_mb),
+    )
+    for chunk in chunks:
+        yield SparseOtuTable(sparse.csr_matrix(chunk.to_numpy(dtype=np.int32)), chunk.index, chunk.columns)
+
+def build_sparse_otu_table(
+    otu_table_path: Path = GLOBALS.RMQS_OTU_TABLE_PATH,
+    max_memory_mb: float = GLOBALS.OTU_CHUNK_MEMORY_MB,
+    ) -> SparseOtuTable:
+    """
+    Parse the gzip OTU table (rows = sites, columns = OTUs) into a CSR matrix.
+    The table is read by chunks of rows so the dense table is never fully in memory.
+    """
+    chunks = list(iter_otu_chunks(otu_table_path, max_memory_mb))
+    matrix = sparse.vstack([chunk.matrix for chunk in chunks], format="csr")
+    sites = pd.Index(np.concatenate([chunk.sites.to_numpy() for chunk in chunks]), name="id_site")
+    return SparseOtuTable(matrix, sites, chunks[0].otus)
+
+def save_sparse_otu_table(table: SparseOtuTable, cache_file: Path) -> None:
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    sites = table.sites.to_numpy()
+    if sites.dtype == object: # store string ids as unicode to avoid pickling
+        sites = sites.astype(str)
+    print(f"Writing {cache_file}")
+    # written aside then renamed, so that a concurrent reader never sees a partial file
+    tmp_file = cache_file.with_name(f"{cache_file.stem}.{os.getpid()}_{threading.get_ident()}.tmp.npz")
+    np.savez_compressed(
+        tmp_file,
+        data=table.matrix.data,
+        indices=table.matrix.indices,
+        indptr=table.matrix.indptr,
+        shape=np.array(table.matrix.shape),
+        sites=sites,
+        otus=table.otus.to_numpy(dtype=str),
+    )
+    os.replace(tmp_file, cache_file)
+    return None
+
+def load_sparse_otu_table(cache_file: Path) -> SparseOtuTable:
+    with np.load(cache_file) as npz:
+        matrix = sparse.csr_matrix((npz["data"], npz["indices"], npz["indptr"]), shape=tuple(npz["shape"]))
+        return SparseOtuTable(matrix, pd.Index(npz["sites"], name="id_site"), pd.Index(npz["otus"]))
+
+def otu_cache_file(
+    otu_table_path: Path = GLOBALS.RMQS_OTU_TABLE_PATH,
+    cache_dir: Path = GLOBALS.OTU_CACHE_DIR,
+    full_hash: bool = False,
+    ) -> Path:
+    """Cache file of the sparse OTU table, named after the fingerprint of the gzip table."""
+    otu_table_path = Path(otu_table_path)
+    key = fingerprint_file(otu_table_path, full_hash=full_hash)
+    stem = otu_table_path.name.split(".")[0]
+    return Path(cache_dir) / f"{stem}_{key}.npz"
+
+def sparse_otu_table_mb(cache_file: Path) -> float:
+    """In-memory size of a cached sparse OTU table, from the uncompressed sizes of its arrays (nothing is read)."""
+    with zipfile.ZipFile(cache_file) as npz:
+        return sum(member.file_size for member in npz.infolist()) / 2**20
+
+def _convert_otu_table(otu_table_path: Path, cache_file: Path) -> SparseOtuTable:
+    """Parses the gzip table into the cache file, replacing the caches of previous versions of the table."""
+    print(f"Reading {otu_table_path}")
+    table = build_sparse_otu_table(otu_table_path)
+    for old_file in cache_file.parent.glob(f"{otu_table_path.name.split('.')[0]}_*.npz"):
+        if old_file != cache_file and not old_file.name.endswith(".tmp.npz"): # files being written by concurrent calls
+            old_file.unlink(missing_ok=True)
+    save_sparse_otu_table(table, cache_file)
+    return table
+
+def build_otu_cache(
+    otu_table_path: Path = GLOBALS.RMQS_OTU_TABLE_PATH,
+    cache_dir: Path = GLOBALS.OTU_CACHE_DIR,
+    full_hash: bool = False,
+    ) -> Path:
+    """
+    Creates the cache file of load_otu_matrix unless it is up to date, without loading it.
+    Called once before stages reading the OTU table run concurrently, so that they do not all parse the gzip table.
+    """
+    cache_file = otu_cache_file(otu_table_path, cache_dir, full_hash)
+    if not cache_file.exists():
+        _convert_otu_table(Path(otu_table_path), cache_file)
+    return cache_file
+
+def load_otu_matrix(
+    otu_table_path: Path = GLOBALS.RMQS_OTU_TABLE_PATH,
+    cache_dir: Path = GLOBALS.OTU_CACHE_DIR,
+    full_hash: bool = False,
+    ) -> SparseOtuTable:
+    """
+    Returns the OTU table as a SparseOtuTable.
+    The first call converts the gzip table and stores it in cache_dir,
+    later calls load the cached arrays as long as the source file fingerprint is unchanged.
+    """
+    cache_file = otu_cache_file(otu_table_path, cache_dir, full_hash)
+    if cache_file.exists():
+        print(f"Reading {cache_file}")
+        return load_sparse_otu_table(cache_file)
+    return _convert_otu_table(Path(otu_table_path), cache_file)
+
+def build_taxon_indicators(
+    taxonomy: pd.DataFrame,
+    otus: pd.Index,
+    levels: list[str] = GLOBALS.TAXONOMIC_LEVELS,
+    ) -> dict[str, TaxonIndicator]:
+    """
+    Builds the OTU -> taxon indicator matrix of every level in one pass over the taxonomy.
+    Rows follow otus (the OTU table columns), OTUs missing from the taxonomy belong to no taxon.
+    """
+    otu_taxa = taxonomy[levels].reindex(otus)
+    if otu_taxa[levels[0]].isna().any():
+        print("Warning: Some OTU IDs in the OTU table are missing from the taxonomy data.")
+
+    indicators = {}
+    for level in levels:
+        taxon_codes, taxa = pd.factorize(otu_taxa[level], sort=True)
+        known = taxon_codes >= 0
+        indicators[level] = TaxonIndicator(
+            sparse.csr_matrix(
+                (np.ones(known.sum(), dtype=np.int32), (np.flatnonzero(known), taxon_codes[known])),
+                shape=(len(otus), len(taxa))),
+            pd.Index(taxa, name=level))
+    return indicators
+
+def aggregate_taxonomic_levels(
+    otu_table: SparseOtuTable,
+    taxonomy: pd.DataFrame,
+    levels: list[str] = GLOBALS.TAXONOMIC_LEVELS,
+    ) -> dict[str, dict[str, pd.DataFrame]]:
+    """
+    Site x taxon tables for every taxonomic level, with one sparse product per level and table.
+    Returns {level: {"abundance": summed sequence count, "presence": number of OTUs present}}.
+    """
+    indicators = build_taxon_indicators(taxonomy, otu_table.otus, levels)
+    presence = otu_table.matrix.copy()
+    presence.data = (presence.data > 0).astype(np.int32)
+
+    tables = {}
+    for level, indicator in indicators.items():
+        tables[level] = {
+            "abundance": pd.DataFrame((otu_table.matrix @ indicator.matrix).toarray(), index=otu_table.sites, columns=indicator.taxa),
+            "presence": pd.DataFrame((presence @ indicator.matrix).toarray(), index=otu_table.sites, columns=indicator.taxa),
+        }
+    return tables
@@ -12,14 +12,14 @@ plot_land_use_distribution(data, "otu_richness", "parent_material", 'parent_mate
 plot_land_use_distribution(data, "otu_richness", "wrb_guess", 'wrb_class')
 plot_land_use_distribution(data, "otu_richness", "signific_ger_95", 'soil_type')
 plot_land_use_distribution(data, "otu_richness", "desc_code_occupation3", 'land_use_fine')
-plot_land_use_distribution(data, "cf", "context", "context", relabel_approach="top_n", param=10)
+plot_land_use_distribution(data, "cf", "context", "context", relabel_approach="top_cats", relabel_param=10)
 
 plot_rmqs_with_attribute(data, "land_use", 'land_use')
 plot_rmqs_with_attribute(data, "parent_material", 'parent_material')
 plot_rmqs_with_attribute(data, "wrb_guess", 'soil_type_wrb')
 plot_rmqs_with_attribute(data, "signific_ger_95", 'soil_type')
 
-plot_heatmap(data, "otu_richness", "land_use", "land_use", 'wrb_guess', "soil_class", top_n=10, func='median')
-plot_heatmap(data, "otu_richness", "land_use", "land_use", "bioregion", "bioregion", top_n=10, func='median')
+plot_heatmap(data, "otu_richness", "land_use", "land_use", 'wrb_guess', "soil_class", func='median')
+plot_heatmap(data, "otu_richness", "land_use", "land_use", "bioregion", "bioregion", func='median')
 
 plot_rmqs_with_regions(data, GLOBALS.EEA_BIOREGION_BORDERS_PATH, 'code', 'bioregion')
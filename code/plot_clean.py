@@ -1,11 +1,18 @@
 import utilities
+from aggregation_cube import load_cube, load_cube_for, query_cube
 
 import matplotlib.pyplot as plt
 import seaborn as sns
 import geopandas as gpd
 import pandas as pd
 
-data_rmqs: gpd.GeoDataFrame = utilities.load_rmqs_data()
+data_rmqs: gpd.GeoDataFrame = utilities.load_rmqs_data(
+    columns=["land_use", "bioregion", "WRB_LVL1", "context", "relative_otu_richness"])
+# every plot shows the 10 most populous contexts, medians and counts are read from the aggregation cube of compute_all,
+# the merged contexts are not in it so context plots query a cube of the relabelled contexts
+data_rmqs = data_rmqs.assign(context=utilities.relabel_bottom(data_rmqs['context'], approach='top_cats', param=10))
+cube = load_cube()
+context_cube = load_cube_for(data_rmqs, dimensions=["context", "land_use"], indicators=["relative_otu_richness"])
 
 kwargs_violin = {
     'inner': 'quartile',
@@ -48,22 +55,24 @@ def add_count_to_series(series : pd.Series, counts: pd.Series) -> pd.Series:
     return series + counts.map(format_counts, na_action="ignore")
 
 def heatmap_pedoclim_croplands():
-    data_rmqs = data_rmqs[data_rmqs["land_use"] == "annual crops"]
-    
-    medians = data_rmqs.pivot_table(
+    medians = query_cube(
+        cube,
         values="relative_otu_richness",
-        index="bioregion",
-        columns="WRB_LVL1",
+        index=["bioregion"],
+        columns=["WRB_LVL1"],
         aggfunc="median",
-        margins=True
+        margins=True,
+        where={"land_use": "annual crops"}
         )
 
-    counts = data_rmqs.pivot_table(
+    counts = query_cube(
+        cube,
         values="relative_otu_richness",
-        index="bioregion",
-        columns="WRB_LVL1",
+        index=["bioregion"],
+        columns=["WRB_LVL1"],
         aggfunc="count",
-        margins=True
+        margins=True,
+        where={"land_use": "annual crops"}
         )
 
     annot_data = add_count_to_series(medians, counts)
@@ -92,21 +101,22 @@ def heatmap_pedoclim_croplands():
     return fig
 
 def heatmap_pedoclim_vs_lu():
-    data_rmqs['context'] = utilities.relabel_bottom(data_rmqs['context'], approach='top_cats', param=10)
     index = ['context']
     values="relative_otu_richness"
     columns="land_use"
-    medians = data_rmqs.pivot_table(
+    medians = query_cube(
+        context_cube,
         values=values,
         index=index,
-        columns=columns,
+        columns=[columns],
         aggfunc="median",
         margins=True)
 
-    counts = data_rmqs.pivot_table(
+    counts = query_cube(
+        context_cube,
         values=values,
         index=index,
-        columns=columns,
+        columns=[columns],
         aggfunc="count",
         margins=True)
 
@@ -136,14 +146,14 @@ def heatmap_pedoclim_vs_lu():
     return fig
 
 def stripplot_context_vs_landuse():
-    data_rmqs['context'] = utilities.relabel_bottom(data_rmqs['context'], approach='top_cats', param=10)
     index = ['context', "land_use"]
     values="relative_otu_richness"
 
-    medians = data_rmqs.pivot_table(
+    medians = query_cube(
+        context_cube,
         values=values,
         index=index,
-        aggfunc="median")
+        aggfunc="median").to_frame()
     
     fig, ax = plt.subplots()
     ax.axvline(1, color='k', ls='dotted')
@@ -169,8 +179,8 @@ def stripplot_context_vs_landuse():
     return None
 
 def boxplot_context_vs_landuse():
-    data_rmqs['context'] = utilities.relabel_bottom(data_rmqs['context'], approach='top_cats', param=10)
-    data_rmqs = data_rmqs[data_rmqs['land_use'].isin(["natural sites", "urban sites"]) == False]
+    data = data_rmqs[data_rmqs['land_use'].isin(["natural sites", "urban sites"]) == False]
+    data = data.assign(land_use=data['land_use'].cat.remove_unused_categories()) # no empty hue slots for the filtered land uses
     x = "relative_otu_richness"
     y = 'context'
     hue = "land_use"
@@ -178,7 +188,7 @@ def boxplot_context_vs_landuse():
     fig, ax = plt.subplots(figsize=(6, 8))
     ax.axvline(1)
     sns.boxplot(
-        data=data_rmqs,
+        data=data,
         x=x,
         y=y,
         hue=hue,
@@ -4,6 +4,7 @@ from matplotlib.ticker import FuncFormatter
 import seaborn as sns
 
 from utilities import save_fig, relabel_bottom, load_rmqs_data
+from aggregation_cube import load_cube_for, pivot_statistics
 
 # globally silence FutureWarning messages
 #import warnings
@@ -33,23 +34,27 @@ def plot_land_use_distribution(
         ) -> plt.Figure:
     """Plots the distribution and median of a specified value column by a grouping attribute."""
     if alias is None: alias = attribute
-    # temporarily remove uninteresting land use classes and tidy data
-    data[attribute] = relabel_bottom(data[attribute], approach=relabel_approach, param=relabel_param)
-    data = data[data["land_use"].isin(['natural sites', 'urban sites']) == False]
+    # tidy data, on a copy of data
+    data = data.assign(**{attribute: relabel_bottom(data[attribute], approach=relabel_approach, param=relabel_param)})
+    data = data.assign(**{attribute: relabel_bottom(data[attribute], approach='top_cats', param=20)}) #reduce size for plotting
     land_use_order = [
         'broadleaved forests',
         'coniferous forests',
         'meadows',
         'annual crops',
         'permanent crops']
-    data[attribute] = relabel_bottom(data[attribute], approach='top_cats', param=20) #reduce size for plotting
 
-    # order categories by median
+    # order categories by median, both summaries are read from the aggregation cube of data (see load_cube_for)
     statistics = ['median', 'count']
-    data_summary = data.pivot_table(values=value,index=[attribute,"land_use"],aggfunc=statistics)
+    dimensions = list(dict.fromkeys([attribute, "land_use"]))
+    cube = load_cube_for(data, dimensions=dimensions, indicators=[value])
+    data_summary = pivot_statistics(cube, value, dimensions, statistics)
+    # remove uninteresting land use classes
+    data_summary = data_summary[data_summary.index.get_level_values("land_use").isin(land_use_order)]
     data_summary = data_summary.sort_values((statistics[0], value), ascending=False)
+    data = data[data["land_use"].isin(land_use_order)]
 
-    attribute_summary = data.pivot_table(values=value,index=attribute,aggfunc=statistics)
+    attribute_summary = data_summary[[(statistics[1], value)]].groupby(level=attribute, observed=True).sum()
     attribute_summary = attribute_summary.sort_values((statistics[1], value), ascending=False)
 
     # figure portrait
@@ -65,7 +70,7 @@ def plot_land_use_distribution(
     if data[value].min() > 100:
         ax.xaxis.set_major_formatter(FuncFormatter(lambda x: f"{x:,.0f}".replace(",", "'")))
     # build y tick labels with counts and set matching tick positions to avoid FixedFormatter warnings
-    yticklabels = [f"{i}\n{statistics[1]}: {val.iloc[1]:.0f}" for i, val in attribute_summary.iterrows()]
+    yticklabels = [f"{i}\n{statistics[1]}: {count:.0f}" for i, count in attribute_summary[(statistics[1], value)].items()]
     ax.set_yticks(range(len(yticklabels)))
     ax.set_yticklabels(yticklabels)
     save_fig(fig, "distribution", f"{value}_by_{attribute}_{alias}")
@@ -73,7 +78,7 @@ def plot_land_use_distribution(
 
 
 if __name__ == "__main__":
-    meta_df = load_rmqs_data()
+    meta_df = load_rmqs_data(columns=["otu_richness", "bioregion", "land_use"])
     plot_land_use_distribution(meta_df, "otu_richness", "bioregion", 'bioregion')
 
 """
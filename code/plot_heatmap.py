@@ -4,6 +4,7 @@ import seaborn as sns
 import matplotlib.pyplot as plt
 
 from utilities import save_fig, relabel_bottom, load_rmqs_data
+from aggregation_cube import load_cube_for, query_cube
 
 def build_pivot(data: pd.DataFrame, 
                 value_field: str,
@@ -15,11 +16,11 @@ def build_pivot(data: pd.DataFrame,
     except KeyError:
         raise KeyError(f"Column {line_field} not found in data.")
     
-    data[line_field] = relabel_bottom(data[line_field], cutoff_quantile=0.9)
+    data = data.assign(**{line_field: relabel_bottom(data[line_field], approach="quantile", param=0.9)})
 
-	# Aggregate richness by land use and soil group
-
-    pvt = data.pivot_table(index=line_field, columns=col_field, values=value_field, aggfunc=func)
+	# Aggregate richness by land use and soil group, read from the precomputed cube unless relabelling merged lines
+    cube = load_cube_for(data, dimensions=[line_field, col_field], indicators=[value_field])
+    pvt = query_cube(cube, value_field, index=[line_field], columns=[col_field], aggfunc=func)
     pvt = pvt.loc[pvt.sum(1).sort_values(ascending=False).index] #sort by total row values
     return pvt
 
@@ -40,7 +41,7 @@ def plot_heatmap(data, value_field, line_field, line_field_alias, col_field, col
 
 
 if __name__ == "__main__":
-    data = load_rmqs_data()
+    data = load_rmqs_data(columns=["otu_richness", "signific_ger_95", "bioregion"])
     plot_heatmap(data, 
                  value_field="otu_richness", 
                  line_field="signific_ger_95", line_field_alias="soil_type", 
@@ -2,7 +2,8 @@ import pandas as pd
 import geopandas as gpd
 import matplotlib.pyplot as plt
 
-from utilities import save_fig, relabel_bottom, box_to_france, load_rmqs_data
+from utilities import save_fig, relabel_bottom, load_rmqs_data
+from geo_utilities import box_to_france
 import GLOBALS
 
 FONTSIZE = 24
@@ -14,7 +15,9 @@ def plot_rmqs_with_attribute(data : gpd.GeoDataFrame, attribute: str, attribute_
         attribute_alias = attribute
     # Relabel to 'others' if there are too many categories to display
     if top_n is not None:
-        data[attribute] = relabel_bottom(data[attribute], approach='top_cats', param=top_n)
+        data = data.assign(**{attribute: relabel_bottom(data[attribute], approach='top_cats', param=top_n)})
+    if isinstance(data[attribute].dtype, pd.CategoricalDtype): # categories without sites would get a legend entry
+        data = data.assign(**{attribute: data[attribute].cat.remove_unused_categories()})
     
     fig, ax = plt.subplots(figsize=(12, 10))  # Adjusted figure size for legend
     # Load background geometry
@@ -25,7 +28,7 @@ def plot_rmqs_with_attribute(data : gpd.GeoDataFrame, attribute: str, attribute_
     if categorical:
         cmap = 'Set1'  # discrete colormap for categories
         if attribute == 'land_use': # Assign colors to each point based on land use (special case)
-            data["color"] = data[attribute].map(GLOBALS.LAND_USE_COLOR_MAPPING).fillna("gray")
+            data = data.assign(color=data[attribute].astype(object).map(GLOBALS.LAND_USE_COLOR_MAPPING).fillna("gray")) # gray is not a land_use category
     else:
         cmap = 'viridis'  # continuous colormap for ranges
 
@@ -98,7 +101,7 @@ def plot_rmqs_with_regions(data: gpd.GeoDataFrame, regions_file, region_col, ali
     return None
 
 if __name__ == "__main__":
-    data = load_rmqs_data()
+    data = load_rmqs_data(columns=["ph_eau_6_1", "bioregion"])
     plot_rmqs_with_attribute(data, "ph_eau_6_1", "soil_ph", False, None)
     #plot_rmqs_with_regions(GLOBALS.EEA_SHP_BIOREGION_PATH, "code", "bioregion")
     subdata = data[data["bioregion"].isna()]
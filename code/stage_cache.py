@@ -0,0 +1,120 @@
+import ast
+import hashlib
+import inspect
+import json
+from pathlib import Path
+from typing import Callable
+
+import pandas as pd
+
+import GLOBALS
+from utilities import fingerprint_file
+
+PROJECT_DIR = Path(__file__).resolve().parent # pipeline modules import each other as top level modules
+
+def project_imports(tree: ast.Module) -> set[str]:
+    """Names of the project modules imported anywhere in a module, including imports inside functions."""
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            names.add(node.module)
+    return {name for name in names if (PROJECT_DIR / f"{name}.py").exists()}
+
+def parse_sources(source_file: Path, follow_imports: bool = True) -> dict[Path, tuple[str, ast.Module]]:
+    """
+    Source and syntax tree of source_file and, with follow_imports, of the project modules it imports
+    directly or not. GLOBALS is left out, stage_key only uses the values the stages read from it.
+    """
+    sources = {}
+    pending = [Path(source_file).resolve()]
+    while pending:
+        path = pending.pop()
+        if path in sources:
+            continue
+        text = path.read_text(encoding="utf-8")
+        sources[path] = (text, ast.parse(text))
+        if follow_imports:
+            pending += [PROJECT_DIR / f"{name}.py" for name in project_imports(sources[path][1]) if name != "GLOBALS"]
+    return sources
+
+def globals_used(trees: list[ast.Module]) -> dict:
+    """Current values of the GLOBALS attributes read (GLOBALS.NAME) in the given modules."""
+    names = {
+        node.attr for tree in trees for node in ast.walk(tree)
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == "GLOBALS"}
+    return {name: getattr(GLOBALS, name) for name in sorted(names) if hasattr(GLOBALS, name)}
+
+def stage_key(
+    stage: Callable,
+    inputs: list[Path] = (),
+    params: dict | None = None,
+    upstream: list[str] = (),
+    follow_imports: bool = True,
+    ) -> str:
+    """
+    Content address of a pipeline stage: fingerprints of its input files, source of the module defining it
+    and of the project modules it imports (unless follow_imports is False), values of the GLOBALS it reads there,
+    its parameters and the keys of the stages it depends on.
+    """
+    sources = parse_sources(inspect.getsourcefile(stage), follow_imports)
+    digest = hashlib.sha1()
+    digest.update(stage.__name__.encode())
+    for path in sorted(sources):
+        digest.update(sources[path][0].encode())
+    for path in inputs:
+        digest.update(fingerprint_file(path).encode())
+    digest.update(json.dumps(globals_used([tree for _, tree in sources.values()]), sort_keys=True, default=str).encode())
+    digest.update(json.dumps(params or {}, sort_keys=True, default=str).encode())
+    for key in upstream:
+        digest.update(key.encode())
+    return digest.hexdigest()[:16]
+
+def read_stage_entry(name: str, cache_dir: Path = GLOBALS.STAGE_CACHE_DIR) -> dict | None:
+    """Key and output crs of the last run of a stage, one file per stage so that stages can run concurrently."""
+    entry_path = Path(cache_dir) / f"{name}.json"
+    if not entry_path.exists():
+        return None
+    with open(entry_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def write_stage_entry(name: str, entry: dict, cache_dir: Path = GLOBALS.STAGE_CACHE_DIR) -> None:
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    with open(Path(cache_dir) / f"{name}.json", "w", encoding="utf-8") as f:
+        json.dump(entry, f, indent=2)
+    return None
+
+def run_cached_stage(
+    data: pd.DataFrame,
+    stage: Callable,
+    out_file: Path,
+    inputs: list[Path] = (),
+    params: dict | None = None,
+    upstream: list[str] = (),
+    how: str = "left",
+    ) -> tuple[pd.DataFrame, str]:
+    """
+    Runs stage(data, **params) unless a previous run with the same key left its intermediate file,
+    in which case the stage columns are read back from out_file and joined to data.
+
+    :param out_file: intermediate csv written by the stage, indexed by id_site and holding the columns it adds
+    :param inputs: files read by the stage
+    :param upstream: keys of the stages producing the columns this stage uses
+    :param how: join used when reading from cache, "inner" for stages dropping sites
+    Returns the data and the stage key, to be passed as upstream to dependent stages.
+    """
+    name = stage.__name__
+    key = stage_key(stage, inputs, params, upstream)
+    entry = read_stage_entry(name)
+    if entry is not None and entry["key"] == key and Path(out_file).exists():
+        print(f"Stage {name} unchanged, reading {out_file}")
+        cached = pd.read_csv(out_file, index_col="id_site")
+        data = data.join(cached, how=how)
+        if entry["crs"] is not None and data.crs != entry["crs"]: # stages may reproject the sites
+            data = data.to_crs(entry["crs"])
+        return data, key
+
+    data = stage(data, **(params or {}))
+    write_stage_entry(name, {"key": key, "crs": data.crs.to_string() if getattr(data, "crs", None) else None})
+    return data, key
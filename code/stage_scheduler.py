@@ -0,0 +1,91 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Callable, NamedTuple
+
+import pandas as pd
+
+from stage_cache import run_cached_stage
+
+class Stage(NamedTuple):
+    """
+    A pipeline stage run through stage_cache.run_cached_stage.
+    - func: stage function, data -> data with new columns, also writing out_file
+    - depends_on: names of the stages whose columns func needs
+    - executor: "thread" for IO/GDAL bound stages, "process" for pandas bound stages,
+      "main" for stages drawing with pyplot (not thread safe, interactive backends need the main thread)
+    see run_cached_stage for the other fields.
+    """
+    func: Callable
+    out_file: Path
+    inputs: list[Path] = ()
+    params: dict | None = None
+    depends_on: tuple[str, ...] = ()
+    executor: str = "thread"
+    how: str = "left"
+
+    @property
+    def name(self) -> str:
+        return self.func.__name__
+
+def merge_stage_outputs(data: pd.DataFrame, outputs: list[tuple[pd.DataFrame, str]]) -> pd.DataFrame:
+    """
+    Adds to data the columns created by each stage output, in the given order.
+    Sites dropped by a stage with how="inner" are dropped, data keeps its own crs.
+    """
+    for output, how in outputs:
+        new_columns = [col for col in output.columns if col not in data.columns]
+        data = data.join(pd.DataFrame(output[new_columns]), how=how)
+    return data
+
+def run_stages(data: pd.DataFrame, stages: list[Stage], base_key: str, max_workers: int | None = None) -> pd.DataFrame:
+    """
+    Runs the stages as soon as their dependencies are done, independent stages running concurrently.
+    Each stage receives its own copy of data with the columns of its dependencies, and the final data gets
+    the columns of all stages merged in the order of the stages list, whatever the completion order.
+
+    :param base_key: key of data, upstream of every stage cache key
+    """
+    stages_by_name = {stage.name: stage for stage in stages}
+    pending = list(stages)
+    done: dict[str, tuple[pd.DataFrame, str]] = {}
+    running = {}
+
+    def dependency_outputs(stage: Stage) -> list[tuple[pd.DataFrame, str]]:
+        return [(done[dep][0], stages_by_name[dep].how) for dep in stage.depends_on]
+
+    def run_stage(stage: Stage, executor=None):
+        """Runs the stage in executor (returns its future) or in the current thread (returns its result)."""
+        print(f"Starting stage {stage.name}")
+        args = (
+            merge_stage_outputs(data, dependency_outputs(stage)).copy(), # stages on threads would share columns
+            stage.func,
+            stage.out_file)
+        kwargs = dict(
+            inputs=stage.inputs,
+            params=stage.params,
+            upstream=[base_key, *[done[dep][1] for dep in stage.depends_on]],
+            how=stage.how)
+        if executor is None:
+            return run_cached_stage(*args, **kwargs)
+        return executor.submit(run_cached_stage, *args, **kwargs)
+
+    # spawned processes, forking while stage threads run can deadlock
+    with ThreadPoolExecutor(max_workers) as threads, ProcessPoolExecutor(max_workers, mp_context=get_context("spawn")) as processes:
+        while pending or running:
+            ready = [stage for stage in pending if all(dep in done for dep in stage.depends_on)]
+            for stage in [stage for stage in ready if stage.executor != "main"]:
+                pending.remove(stage)
+                running[run_stage(stage, processes if stage.executor == "process" else threads)] = stage.name
+            main_stages = [stage for stage in ready if stage.executor == "main"]
+            if main_stages: # the pool stages keep running meanwhile
+                pending.remove(main_stages[0])
+                done[main_stages[0].name] = run_stage(main_stages[0])
+                continue
+            if not running:
+                raise ValueError(f"Stages {[stage.name for stage in pending]} have missing or circular dependencies.")
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                done[running.pop(future)] = future.result()
+
+    return merge_stage_outputs(data, [(done[stage.name][0], stage.how) for stage in stages])
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the pipeline modules import each other as top level modules from the code directory
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
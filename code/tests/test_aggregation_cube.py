@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+import pandas as pd
+
+from aggregation_cube import build_cube, write_cube, load_cube, load_cube_for, query_cube
+
+def make_sites():
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        "land_use": pd.Categorical(rng.choice(["meadows", "annual crops"], 60)),
+        "bioregion": pd.Categorical(rng.choice(["ATL", "CON", "MED", "ALP"], 60, p=[0.4, 0.4, 0.15, 0.05])),
+        "otu_richness": rng.integers(100, 200, 60).astype(float),
+        })
+
+def test_load_cube_for_reads_the_precomputed_cube(tmp_path):
+    sites = make_sites()
+    cube_file = tmp_path / "cube.parquet"
+    write_cube(build_cube(sites, dimensions=["land_use", "bioregion"], indicators=["otu_richness"]), cube_file)
+    cube = load_cube_for(sites, ["bioregion", "land_use"], ["otu_richness"], cube_file=cube_file)
+    pd.testing.assert_frame_equal(cube, pd.read_parquet(cube_file))
+
+def test_load_cube_for_aggregates_merged_groups(tmp_path):
+    sites = make_sites()
+    cube_file = tmp_path / "cube.parquet"
+    write_cube(build_cube(sites, dimensions=["land_use", "bioregion"], indicators=["otu_richness"]), cube_file)
+    merged = sites.assign(bioregion=sites["bioregion"].astype(str).replace({"MED": "Others", "ALP": "Others"}))
+    cube = load_cube_for(merged, ["bioregion", "land_use"], ["otu_richness"], cube_file=cube_file)
+    medians = query_cube(cube, "otu_richness", index=["bioregion"])
+    assert medians["Others"] == merged.loc[merged["bioregion"] == "Others", "otu_richness"].median()
+
+def test_load_cube_for_aggregates_changed_values(tmp_path):
+    sites = make_sites()
+    cube_file = tmp_path / "cube.parquet"
+    write_cube(build_cube(sites, dimensions=["land_use", "bioregion"], indicators=["otu_richness"]), cube_file)
+    doubled = sites.assign(otu_richness=2 * sites["otu_richness"])
+    cube = load_cube_for(doubled, ["bioregion", "land_use"], ["otu_richness"], cube_file=cube_file)
+    medians = query_cube(cube, "otu_richness", index=["land_use"])
+    pd.testing.assert_series_equal(medians, doubled.groupby("land_use", observed=True)["otu_richness"].median(), check_names=False)
+
+def test_load_cube_raises_without_cube(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        load_cube(tmp_path / "cube.parquet")
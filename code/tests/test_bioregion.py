@@ -0,0 +1,28 @@
+from functools import partial
+
+import geopandas as gpd
+from shapely.geometry import Point, box
+
+import GLOBALS
+import compute_bioregion
+from compute_bioregion import RegionLayer, assign_regions
+
+def test_corsican_site_keeps_its_region(monkeypatch, tmp_path):
+    # mainland and Corsica (x ~ 1.17e6 - 1.24e6 in Lambert-93, beyond FRANCE_BOX_EPSG_2154)
+    france_path = tmp_path / "france.geojson"
+    gpd.GeoDataFrame(
+        geometry=[box(1.0e5, 6.05e6, 1.08e6, 7.11e6), box(1.17e6, 6.04e6, 1.24e6, 6.24e6)],
+        crs=GLOBALS.CRS_RMQS).to_file(france_path)
+    regions_path = tmp_path / "regions.gpkg"
+    gpd.GeoDataFrame(
+        {"code": ["atlantic", "mediterranean"]},
+        geometry=[box(1.0e5, 6.3e6, 9.0e5, 7.1e6), box(9.0e5, 6.0e6, 1.3e6, 6.4e6)],
+        crs=GLOBALS.CRS_RMQS).to_file(regions_path)
+    monkeypatch.setattr(GLOBALS, "FRANCE_BORDERS_PATH", france_path)
+    monkeypatch.setattr(compute_bioregion, "load_region_layer",
+                        partial(compute_bioregion.load_region_layer, cache_dir=tmp_path / "cache"))
+
+    sites = gpd.GeoDataFrame(geometry=[Point(1.2e6, 6.15e6), Point(5.0e5, 6.8e6)], crs=GLOBALS.CRS_RMQS)
+    regions, report = assign_regions(sites, [RegionLayer(regions_path, "code", "bioregion")])
+    assert list(regions["bioregion"]) == ["mediterranean", "atlantic"]
+    assert report.loc["bioregion", "missing"] == 0
@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+import GLOBALS
+from otu_utilities import SparseOtuTable
+from compute_otu_metrics import (
+    compute_alpha_diversity, compute_mean_level_abundance, compute_otu_metrics_streaming, compute_otu_metrics_table)
+
+def make_table(counts, sites=("s1", "s2"), otus=("o1", "o2", "o3")):
+    return SparseOtuTable(sparse.csr_matrix(np.array(counts)), pd.Index(sites, name="id_site"), pd.Index(otus))
+
+def test_mean_level_abundance_is_per_site():
+    table = make_table([[2, 4, 9], [0, 0, 3]])
+    taxonomy = pd.DataFrame({"ORDER": ["A", "A", "B"]}, index=["o1", "o2", "o3"])
+    result = compute_mean_level_abundance(table, taxonomy, level="ORDER")
+    # s1: taxon A mean (2 + 4) / 2 = 3, taxon B 9 -> 6; s2: A 0, B 3 -> 1.5
+    assert list(result.index) == ["s1", "s2"]
+    assert list(result.columns) == ["mean_ORDER_abundance"]
+    np.testing.assert_allclose(result["mean_ORDER_abundance"], [6, 1.5])
+
+def test_alpha_diversity_is_nan_without_reads():
+    table = make_table([[5, 5, 0], [0, 0, 0]])
+    result = compute_alpha_diversity(table)
+    np.testing.assert_allclose(result.loc["s1", ["otu_shannon", "otu_simpson"]], [np.log(2), 0.5])
+    assert result.loc["s2"].isna().all()
+
+def test_streaming_metrics_match_the_sparse_table(monkeypatch, tmp_path):
+    table = make_table([[2, 4, 9], [0, 0, 3], [1, 0, 0]], sites=(1, 2, 3))
+    otu_path = tmp_path / "otu.tsv.gz"
+    table.to_dataframe().rename_axis("id_site").to_csv(otu_path, sep="\t", compression="gzip")
+    monkeypatch.setattr(GLOBALS, "RMQS_OTU_TABLE_PATH", otu_path)
+    taxonomy = pd.DataFrame({"ORDER": ["A", "A", "B"]}, index=["o1", "o2", "o3"])
+    streamed = compute_otu_metrics_streaming(taxonomy, max_memory_mb=1e-4) # one site per chunk
+    pd.testing.assert_frame_equal(streamed, compute_otu_metrics_table(table, taxonomy), check_dtype=False, check_index_type=False)
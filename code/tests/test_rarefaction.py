@@ -0,0 +1,20 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from otu_utilities import SparseOtuTable
+from compute_rarefaction import compute_rarefied_richness
+
+def test_empty_site_does_not_set_the_depth():
+    counts = np.array([[0, 0, 0], [50, 30, 20], [40, 40, 20], [10, 5, 0]])
+    table = SparseOtuTable(sparse.csr_matrix(counts), pd.Index([1, 2, 3, 4], name="id_site"), pd.Index(["a", "b", "c"]))
+    richness = compute_rarefied_richness(table, n_iter=5, max_workers=1, depth_quantile=0.5)
+    # depth is the median of the non-empty totals (100), shallower sites are excluded
+    assert richness[[1, 4]].isna().all()
+    assert (richness[[2, 3]] == 3).all()
+
+def test_rarefaction_does_not_depend_on_max_workers():
+    counts = np.random.default_rng(0).integers(0, 20, size=(12, 30))
+    table = SparseOtuTable(sparse.csr_matrix(counts), pd.Index(range(12), name="id_site"), pd.Index(range(30)))
+    serial = compute_rarefied_richness(table, n_iter=5, max_workers=1)
+    pd.testing.assert_series_equal(compute_rarefied_richness(table, n_iter=5, max_workers=2), serial)
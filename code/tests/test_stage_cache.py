@@ -0,0 +1,18 @@
+import GLOBALS
+from stage_cache import stage_key
+
+def relabel_stage(data):
+    return data, GLOBALS.WRB_RELABEL_PARAM
+
+def test_stage_key_changes_with_globals_read_by_stage(monkeypatch):
+    key = stage_key(relabel_stage)
+    assert stage_key(relabel_stage) == key
+    monkeypatch.setattr(GLOBALS, "WRB_RELABEL_PARAM", GLOBALS.WRB_RELABEL_PARAM + 1)
+    assert stage_key(relabel_stage) != key
+
+def test_stage_key_follows_project_imports(monkeypatch):
+    from compute_cf import compute_land_use_cf_median_context
+    key = stage_key(compute_land_use_cf_median_context)
+    # CF_BOOTSTRAP_ITERATIONS is only read in compute_cf_bootstrap, imported by compute_cf
+    monkeypatch.setattr(GLOBALS, "CF_BOOTSTRAP_ITERATIONS", GLOBALS.CF_BOOTSTRAP_ITERATIONS + 1)
+    assert stage_key(compute_land_use_cf_median_context) != key
@@ -0,0 +1,45 @@
+import threading
+
+import pandas as pd
+
+import stage_cache
+from stage_scheduler import Stage, run_stages
+
+def test_root_stages_get_their_own_data(monkeypatch, tmp_path):
+    monkeypatch.setattr(stage_cache, "read_stage_entry", lambda name: None)
+    monkeypatch.setattr(stage_cache, "write_stage_entry", lambda name, entry: None)
+    both_written = threading.Barrier(2, timeout=10)
+
+    def write_label(data, label):
+        data["label"] = label
+        both_written.wait() # the other stage has written its label too
+        data[f"seen_{label}"] = data["label"]
+        return data
+
+    def stage_a(data):
+        return write_label(data, "a")
+
+    def stage_b(data):
+        return write_label(data, "b")
+
+    data = pd.DataFrame({"x": [1, 2]}, index=pd.Index([1, 2], name="id_site"))
+    result = run_stages(data, [Stage(stage_a, tmp_path / "a.csv"), Stage(stage_b, tmp_path / "b.csv")], "base", max_workers=2)
+    assert (result["seen_a"] == "a").all()
+    assert (result["seen_b"] == "b").all()
+    assert list(data.columns) == ["x"]
+
+def test_main_stages_run_on_the_main_thread(monkeypatch, tmp_path):
+    monkeypatch.setattr(stage_cache, "read_stage_entry", lambda name: None)
+    monkeypatch.setattr(stage_cache, "write_stage_entry", lambda name, entry: None)
+
+    def root_stage(data):
+        return data.assign(root_thread=threading.current_thread().name)
+
+    def plot_stage(data):
+        return data.assign(plot_thread=threading.current_thread().name)
+
+    data = pd.DataFrame({"x": [1, 2]}, index=pd.Index([1, 2], name="id_site"))
+    stages = [Stage(root_stage, tmp_path / "a.csv"), Stage(plot_stage, tmp_path / "b.csv", depends_on=("root_stage",), executor="main")]
+    result = run_stages(data, stages, "base")
+    assert (result["plot_thread"] == threading.main_thread().name).all()
+    assert (result["root_thread"] != threading.main_thread().name).all()
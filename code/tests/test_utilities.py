@@ -0,0 +1,17 @@
+import pandas as pd
+
+from utilities import category_counts, run_batches, shared_data
+
+def test_category_counts_follow_in_place_edits():
+    data = pd.DataFrame({"WRB_LVL1": pd.Categorical(["Cambisol", "Cambisol", "Luvisol"], categories=["Cambisol", "Luvisol", "Podzol"])})
+    assert category_counts(data["WRB_LVL1"]).to_dict() == {"Cambisol": 2, "Luvisol": 1, "Podzol": 0}
+    data.loc[0, "WRB_LVL1"] = "Podzol"
+    assert category_counts(data["WRB_LVL1"]).to_dict() == {"Cambisol": 1, "Luvisol": 1, "Podzol": 1}
+
+def offset_item(item):
+    return item + shared_data()["offset"]
+
+def test_run_batches_keeps_item_order_with_shared_data():
+    expected = [i + 100 for i in range(10)]
+    assert list(run_batches(offset_item, range(10), max_workers=1, shared={"offset": 100})) == expected
+    assert list(run_batches(offset_item, range(10), max_workers=2, shared={"offset": 100})) == expected
@@ -1,6 +1,12 @@
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from multiprocessing import get_context
 from pathlib import Path
+from typing import Callable, Iterable, Iterator
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
@@ -25,25 +31,72 @@ def rename_land_use(data: gpd.GeoDataFrame):
     - keep desc_code_occupation1 except for 'surfaces boisees'
     - for 'surfaces boisees' use desc_code_occupation3 but only keep allowed subclasses
     - rows with other forest subclasses are set to NaN (dropped later)
+    land_use is an ordered categorical (GLOBALS.LAND_USE_ORDER).
     """
     # renommer toutes les forets qui ne sont pas caducifoliees en coniferes (eg mixte > coniferes)
-    def make_custom(row):
-        keep1 = "surfaces boisees"
-        keep3 = "forets caducifoliees"
-        other3 = "forets de coniferes"
-        if row["desc_code_occupation1"] == keep1:
-            if row["desc_code_occupation3"] == keep3:
-                return keep3
-            return other3
-        return row["desc_code_occupation1"]
-
-    data["land_use"] = data.apply(make_custom, axis=1)
-    data["land_use"] = data["land_use"].map(GLOBALS.LAND_USE_SIMPLE_MAPPING)
+    is_wood = (data["desc_code_occupation1"] == "surfaces boisees").to_numpy()
+    is_broadleaved = (data["desc_code_occupation3"] == "forets caducifoliees").to_numpy()
+    land_use = np.select(
+        [is_wood & is_broadleaved, is_wood],
+        ["forets caducifoliees", "forets de coniferes"],
+        default=data["desc_code_occupation1"].to_numpy(dtype=object))
+    land_use = pd.Series(land_use, index=data.index).map(GLOBALS.LAND_USE_SIMPLE_MAPPING)
+    data["land_use"] = pd.Categorical(land_use, categories=GLOBALS.LAND_USE_ORDER, ordered=True)
 
     #add land use intensity levels
-    data["land_use_intensity"] = data["land_use"].map(GLOBALS.LAND_USE_INTENSITY_MAPPING)
+    data["land_use_intensity"] = data["land_use"].map(GLOBALS.LAND_USE_INTENSITY_MAPPING).astype(float)
     return data
 
+def to_categoricals(data: pd.DataFrame, columns: list[str] = GLOBALS.CATEGORICAL_COLUMNS) -> pd.DataFrame:
+    """
+    Converts the label columns of the site table to categoricals, land_use ordered by intensity
+    and other columns by sorted label. Columns missing from data are skipped.
+    """
+    for column in [col for col in columns if col in data.columns]:
+        if column == "land_use":
+            data[column] = pd.Categorical(data[column], categories=GLOBALS.LAND_USE_ORDER, ordered=True)
+        elif not isinstance(data[column].dtype, pd.CategoricalDtype):
+            data[column] = data[column].astype("category")
+    return data
+
+def bottom_values(counts: pd.Series, approach: str = "quantile", param = 0.8) -> pd.Index:
+    """
+    Rare values to relabel following a grouping approach (see relabel_bottom),
+    from the value counts of a series sorted in descending order.
+    """
+    match approach:
+        case "top_cats":
+            if type(param) is not int:
+                raise ValueError("For 'top_cats' approach, param must be an integer.")
+            top_n = param
+            return counts.index[top_n:]
+        case "quantile":
+            if type(param) is not float:
+                raise ValueError("For 'quantile' approach, param must be a float.")
+            cutoff_quantile = param
+            cumvalues = (counts / counts.sum()).cumsum()
+            return counts.index[(cumvalues > cutoff_quantile).to_numpy()]
+        case 'min_val_count':
+            if type(param) is not int:
+                raise ValueError("For 'min_val_count' approach, param must be an integer.")
+            val_count = param
+            return counts.index[(counts <= val_count).to_numpy()]
+        case None:
+            return counts.index[:0]
+        case _:
+            raise ValueError("approach has an invalid value.")
+
+def category_counts(series: pd.Series) -> pd.Series:
+    """Site count of every category of a categorical series, unobserved categories included, in category order."""
+    return series.value_counts(sort=False, dropna=True)
+
+def observed_value_counts(series: pd.Series) -> pd.Series:
+    """Counts of the values present in series, in descending order, ties following the category order."""
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        series = series.astype("category")
+    counts = category_counts(series)
+    return counts[counts > 0].sort_values(ascending=False, kind="stable")
+
 def relabel_bottom(series: pd.Series, 
                    approach: str = "quantile", 
                    param = 0.8, 
@@ -52,10 +105,11 @@ def relabel_bottom(series: pd.Series,
     """
     Relabel rare values of a series to a grouping label 
     following a given grouping approach.
-    Returns the modified series.
+    Returns a new categorical series where the rare categories are merged into bottom_label,
+    the input series is not modified.
     
     
-    :param series: Series that will be modified
+    :param series: Series to relabel, preferably categorical (value counts then come from the codes)
     :type series: pd.Series
     :param approach: Choice of the approach used to classify rare values among top_cats, quantile, min_val_count
      - 'top_cats' keeps only the "top_n" most populous values based on value counts
@@ -64,39 +118,89 @@ def relabel_bottom(series: pd.Series,
     :type approach str
     :param param: value of the parameter used in the grouping approach
     :param bottom_label: Name of the new value for rare values
-    :return: Modified input series
+    :return: Relabelled copy of the input series
     :rtype: Series[Any]
     """
-    match approach:
-        case "top_cats":
-            if type(param) is not int:
-                raise ValueError("For 'top_cats' approach, param must be an integer.")
-            top_n = param
-            if series.nunique() > top_n:
-                top_values = series.value_counts()
-                others = top_values[top_n:].index
-            else:
-                return series
-        case "quantile":
-            if type(param) is not float:
-                raise ValueError("For 'quantile' approach, param must be a float.")
-            cutoff_quantile = param
-            top_values = series.value_counts(normalize=True)
-            cumvalues = top_values.cumsum()
-            others = top_values[cumvalues > cutoff_quantile].index
-        case 'min_val_count':
-            if type(param) is not int:
-                raise ValueError("For 'min_val_count' approach, param must be an integer.")
-            val_count = param
-            top_values = series.value_counts()
-            others = top_values[top_values <= val_count].index
-        case None:
-            return series
-        case _:
-            raise ValueError("approach has an invalid value.")
+    if approach is None:
+        return series
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        series = series.astype("category")
+    counts = observed_value_counts(series)
+    others = bottom_values(counts, approach, param)
+    if len(others) == 0:
+        return series
     
-    print(f"Relabelling {len(series[series.isin(others)])} values from {list(others)} to {bottom_label} in {series.name}.")
-    return series.replace(to_replace=others, value=bottom_label)
+    print(f"Relabelling {counts[others].sum()} values from {list(others)} to {bottom_label} in {series.name}.")
+    # merge the categories on the codes: each old category code points to its kept category or to bottom_label
+    values = series.array
+    merged = values.categories.isin(others)
+    categories = values.categories[~merged]
+    if bottom_label not in categories:
+        categories = categories.append(pd.Index([bottom_label]))
+    code_map = categories.get_indexer(np.where(merged, bottom_label, values.categories.astype(object)))
+    codes = np.where(values.codes >= 0, code_map[values.codes], -1)
+    relabelled = pd.Categorical.from_codes(codes, categories=categories, ordered=values.ordered)
+    return pd.Series(relabelled, index=series.index, name=series.name)
+
+def fingerprint_file(path: Path, full_hash: bool = False) -> str:
+    """
+    Short fingerprint of a file used as cache key.
+    By default based on name, size and modification time (instantaneous),
+    full_hash=True hashes the file content instead (reads the whole file).
+    """
+    path = Path(path)
+    digest = hashlib.sha1()
+    if full_hash:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    else:
+        stat = path.stat()
+        digest.update(f"{path.name}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()[:16]
+
+# read-only data of the current run_batches call, set once per worker process (see shared_data)
+_SHARED = None
+
+def _init_batch_worker(shared) -> None:
+    global _SHARED
+    _SHARED = shared
+
+def shared_data():
+    """The shared argument of the run_batches call running the current worker function."""
+    return _SHARED
+
+def _run_batch(func: Callable, batch: list) -> list:
+    return [func(item) for item in batch]
+
+def run_batches(
+    func: Callable,
+    items: Iterable,
+    max_workers: int | None = None,
+    shared = None,
+    n_batches: int | None = None,
+    ) -> Iterator:
+    """
+    Yields func(item) for every item, in item order, computed in a process pool receiving the items
+    by batches (n_batches, defaults to 4 per worker).
+    shared is sent once to each worker, where func reads it with shared_data(), instead of with every batch.
+    The pool spawns its processes: pipeline stages call it from threads, and forking a multi-threaded process can deadlock.
+
+    :param func: module level function (or functools.partial of one), so that spawned workers can import it
+    :param max_workers: number of processes, 1 runs in the current process
+    """
+    items = list(items)
+    if max_workers == 1:
+        _init_batch_worker(shared)
+        yield from map(func, items)
+        return
+    if not items:
+        return
+    n_batches = min(len(items), n_batches or 4 * (max_workers or 8))
+    batches = [[items[i] for i in batch] for batch in np.array_split(np.arange(len(items)), n_batches)]
+    with ProcessPoolExecutor(max_workers, mp_context=get_context("spawn"), initializer=_init_batch_worker, initargs=(shared,)) as executor:
+        for results in executor.map(_run_batch, repeat(func), batches):
+            yield from results
 
 def write_csv(df: pd.DataFrame, outfile: str | Path):
     print(f"Writing {outfile}")
@@ -110,12 +214,59 @@ def save_fig(fig: plt.Figure, folder: str, title: str):
     print(f"Saved figure to: {out_path}")
     return None
 
-def load_rmqs_data() -> gpd.GeoDataFrame:
+def write_rmqs_data(data: gpd.GeoDataFrame, outfile: Path = GLOBALS.RMQS_FINAL_PARQUET_PATH) -> None:
     """
-    Loads the rmqs data with all calculated attributes from a generated csv file
+    Writes the site table as GeoParquet, with typed and categorical columns.
+    Sites are sorted by land_use and bioregion so that filters on them skip whole row groups.
     """
+    sort_columns = [col for col in ["land_use", "bioregion"] if col in data.columns]
+    print(f"Writing {outfile}")
+    data.sort_values(sort_columns).to_parquet(outfile, row_group_size=GLOBALS.RMQS_FINAL_ROW_GROUP_SIZE)
+    return None
+
+def filter_mask(data: pd.DataFrame, filter: list) -> pd.Series:
+    """
+    Boolean mask of the rows of data matching a pyarrow-style filter:
+    a list of (column, op, value) conditions combined with AND, or a list of such lists combined with OR.
+    """
+    if isinstance(filter[0], list):
+        return np.logical_or.reduce([filter_mask(data, conjunction) for conjunction in filter])
+    mask = pd.Series(True, index=data.index)
+    for column, op, value in filter:
+        series = data[column]
+        match op:
+            case "==" | "=": mask &= series == value
+            case "!=": mask &= series != value
+            case "<": mask &= series < value
+            case "<=": mask &= series <= value
+            case ">": mask &= series > value
+            case ">=": mask &= series >= value
+            case "in": mask &= series.isin(value)
+            case "not in": mask &= ~series.isin(value)
+            case _: raise ValueError(f"Unsupported filter operator {op}.")
+    return mask
+
+def load_rmqs_data(columns: list[str] | None = None, filter: list | None = None) -> gpd.GeoDataFrame:
+    """
+    Loads the rmqs data with all calculated attributes from the GeoParquet written by compute_all,
+    reading only the given columns (geometry and the id_site index are always read)
+    and the row groups that can match filter, eg [("land_use", "==", "meadows")] (see filter_mask).
+    Falls back to the GeoPackage if the GeoParquet does not exist.
+    """
+    if columns is not None:
+        columns = list(dict.fromkeys([*columns, "geometry"]))
+    data_file = GLOBALS.RMQS_FINAL_PARQUET_PATH
+    if data_file.exists():
+        print(f"Reading {data_file}")
+        data = gpd.read_parquet(data_file, columns=columns, filters=filter)
+        return to_categoricals(data)
+
     data_file = GLOBALS.RMQS_FINAL_GEO_PATH
     print(f"Reading {data_file}")
     data =  gpd.read_file(data_file)
     data.set_index('id_site', inplace=True)
-    return data
\ No newline at end of file
+    if filter is not None:
+        data = data[filter_mask(data, filter)]
+    if columns is not None:
+        data = data[columns]
+    return to_categoricals(data)
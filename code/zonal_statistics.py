@@ -0,0 +1,155 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+import rasterio.features as rfeatures
+import rasterio.windows as rwindows
+from shapely import STRtree
+from shapely.geometry import box
+
+from geo_utilities import bounds_to_window, xy_to_rowcol
+
+def class_range(dtype) -> tuple[int, int]:
+    """Smallest value and number of possible values of a categorical (8 or 16 bit integer) raster."""
+    dtype = np.dtype(dtype)
+    if dtype.kind not in "iu" or dtype.itemsize > 2:
+        raise ValueError(f"Categorical rasters must be 8 or 16 bit integers, got {dtype}.")
+    info = np.iinfo(dtype)
+    return int(info.min), int(info.max) - int(info.min) + 1
+
+def rasterize_zones(shapes: list, tree: STRtree, out_shape: tuple[int, int], transform) -> np.ndarray:
+    """Zone id (position in shapes + 1, 0 outside every zone) of each pixel, pixel centers decide as in rasterstats."""
+    zone_ids = tree.query(box(*rwindows.bounds(rwindows.Window(0, 0, out_shape[1], out_shape[0]), transform)))
+    if len(zone_ids) == 0:
+        return np.zeros(out_shape, dtype=np.int32)
+    return rfeatures.rasterize(
+        [(shapes[i], i + 1) for i in zone_ids], out_shape=out_shape, transform=transform, fill=0, dtype=np.int32)
+
+def categorical_zonal_counts(zones: gpd.GeoSeries, raster_path: Path, band: int = 1, block_rows: int = 512) -> pd.DataFrame:
+    """
+    Pixel count of every (zone, raster class) pair, replacing rasterstats.zonal_stats(categorical=True).
+    The zones are rasterized onto the raster grid block by block (strips of block_rows rows within the zones bounds),
+    and each block adds a single bincount over the combined zone x class codes. Nodata pixels are ignored.
+
+    :param zones: polygons indexed by zone label
+    Returns a DataFrame with columns zone (named after zones.index), value (raster class) and pixel_count.
+    """
+    with rasterio.open(raster_path) as raster:
+        zones = zones.to_crs(raster.crs)
+        shapes = list(zones.geometry)
+        tree = STRtree(shapes)
+        class_min, class_count = class_range(raster.dtypes[band - 1])
+        counts = np.zeros((len(shapes) + 1) * class_count, dtype=np.int64)
+        window = bounds_to_window(raster, zones.total_bounds)
+        for row in range(0, window.height, block_rows):
+            block = rwindows.Window(window.col_off, window.row_off + row, window.width, min(block_rows, window.height - row))
+            values = raster.read(band, window=block)
+            zone_ids = rasterize_zones(shapes, tree, values.shape, raster.window_transform(block))
+            valid = zone_ids > 0
+            if raster.nodata is not None:
+                valid &= values != raster.nodata
+            codes = zone_ids[valid].astype(np.int64) * class_count + (values[valid].astype(np.int64) - class_min)
+            counts += np.bincount(codes, minlength=counts.size)
+
+    counts = counts.reshape(len(shapes) + 1, class_count)[1:] # drop zone id 0 (outside zones)
+    zone_pos, class_pos = np.nonzero(counts)
+    return pd.DataFrame({
+        zones.index.name or "zone": zones.index[zone_pos],
+        "value": class_pos + class_min,
+        "pixel_count": counts[zone_pos, class_pos],
+        })
+
+def count_codes(codes: np.ndarray, size: int, max_dense_size: int = 2**22) -> tuple[np.ndarray, np.ndarray]:
+    """Distinct codes (all below size) and their counts, with a bincount when size is small enough, np.unique otherwise."""
+    if size <= max_dense_size:
+        counts = np.bincount(codes, minlength=size)
+        present = np.flatnonzero(counts)
+        return present, counts[present]
+    return np.unique(codes, return_counts=True)
+
+def categorical_zonal_crosstab(
+    zones: gpd.GeoSeries,
+    fine_raster_path: Path,
+    coarse_raster_path: Path,
+    block_rows: int = 256,
+    max_workers: int = 4,
+    ) -> pd.DataFrame:
+    """
+    Pixel count of every (zone, coarse raster class, fine raster class) triple, on the grid of the fine raster.
+    Both rasters must share their crs (eg CORINE 100 m and WRB 1 km, EPSG:3035). The coarse raster is aligned
+    on the fly: each fine pixel takes the coarse pixel containing its center, no resampled copy is written.
+    Strips of block_rows fine rows are processed on a thread pool, each thread with its own dataset handles.
+    Nodata pixels of either raster are ignored.
+
+    :param zones: polygons indexed by zone label
+    Returns a DataFrame with columns zone (named after zones.index), coarse_value, fine_value and pixel_count.
+    """
+    with rasterio.open(fine_raster_path) as fine, rasterio.open(coarse_raster_path) as coarse:
+        if fine.crs != coarse.crs:
+            raise ValueError("Cross-tabulated rasters must share the same crs.")
+        zones = zones.to_crs(fine.crs)
+        window = bounds_to_window(fine, zones.total_bounds)
+        fine_transform, coarse_transform = fine.transform, coarse.transform
+        fine_nodata, coarse_nodata = fine.nodata, coarse.nodata
+        fine_min, fine_count = class_range(fine.dtypes[0])
+        coarse_min, coarse_count = class_range(coarse.dtypes[0])
+        coarse_fill = coarse_nodata if coarse_nodata is not None else 0
+    shapes = list(zones.geometry)
+    tree = STRtree(shapes)
+    size = (len(shapes) + 1) * coarse_count * fine_count
+    thread_data = threading.local()
+    thread_rasters = []
+
+    def crosstab_strip(block: rwindows.Window) -> tuple[np.ndarray, np.ndarray]:
+        if not hasattr(thread_data, "fine"):
+            thread_data.fine, thread_data.coarse = rasterio.open(fine_raster_path), rasterio.open(coarse_raster_path)
+            thread_rasters.extend([thread_data.fine, thread_data.coarse])
+        block_transform = rwindows.transform(block, fine_transform)
+        zone_ids = rasterize_zones(shapes, tree, (block.height, block.width), block_transform)
+        if not zone_ids.any():
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        fine_values = thread_data.fine.read(1, window=block)
+
+        # coarse pixel of each fine pixel center, north-up grids: rows only depend on y and cols on x
+        xs = block_transform.c + (np.arange(block.width) + 0.5) * block_transform.a
+        ys = block_transform.f + (np.arange(block.height) + 0.5) * block_transform.e
+        coarse_rows, _ = xy_to_rowcol(coarse_transform, np.full(len(ys), xs[0]), ys)
+        _, coarse_cols = xy_to_rowcol(coarse_transform, xs, np.full(len(xs), ys[0]))
+        row_off, col_off = coarse_rows.min(), coarse_cols.min()
+        coarse_window = rwindows.Window(col_off, row_off, coarse_cols.max() - col_off + 1, coarse_rows.max() - row_off + 1)
+        coarse_block = thread_data.coarse.read(1, window=coarse_window, boundless=True, fill_value=coarse_fill)
+        coarse_values = coarse_block[(coarse_rows - row_off)[:, None], (coarse_cols - col_off)[None, :]]
+
+        valid = zone_ids > 0
+        if fine_nodata is not None:
+            valid &= fine_values != fine_nodata
+        if coarse_nodata is not None:
+            valid &= coarse_values != coarse_nodata
+        codes = (zone_ids[valid].astype(np.int64) * coarse_count
+                 + (coarse_values[valid].astype(np.int64) - coarse_min)) * fine_count \
+                + (fine_values[valid].astype(np.int64) - fine_min)
+        return count_codes(codes, size)
+
+    strips = [
+        rwindows.Window(window.col_off, window.row_off + row, window.width, min(block_rows, window.height - row))
+        for row in range(0, window.height, block_rows)]
+    with ThreadPoolExecutor(max_workers) as executor:
+        results = list(executor.map(crosstab_strip, strips))
+    for raster in thread_rasters:
+        raster.close()
+
+    counts = pd.Series(
+        np.concatenate([strip_counts for _, strip_counts in results]),
+        index=np.concatenate([strip_codes for strip_codes, _ in results])).groupby(level=0).sum()
+    codes = counts.index.to_numpy()
+    zone_pos = codes // (coarse_count * fine_count) - 1
+    return pd.DataFrame({
+        zones.index.name or "zone": zones.index[zone_pos],
+        "coarse_value": (codes // fine_count) % coarse_count + coarse_min,
+        "fine_value": codes % fine_count + fine_min,
+        "pixel_count": counts.to_numpy(),
+        })